@@ -0,0 +1,228 @@
+"""
+Inter-annotator agreement over the processed (BeNASch) files.
+The files of all annotators of a document ({annotator}_{document}.benasch.xml) are compared pairwise:
+- spans, by element (one layer per element, the label is the class)
+- relations (the label is the class)
+- events (the trigger, the label is the class of the event group)
+- event roles (one layer per role, the role's span within an event with the same class and trigger)
+
+Per layer and pair of annotators we report
+- exact F1: same start, end and label
+- partial F1: exact matches plus overlapping units with the same label (matched one to one)
+- kappa: Cohen's kappa of the labels over all positions (start, end) annotated by at least one of the two
+
+Units are aligned with a sweep over the sorted units instead of comparing all pairs,
+so the time grows linearly with the size of the documents. Documents are compared in parallel.
+"""
+
+import heapq
+import itertools
+import json
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+
+from transformation.to_column import parse_document, DEFAULT_NAMESPACE
+from unzip_export import split_filename
+
+
+# SET PATH TO RELEVANT CORPUS FOLDER
+DATA = "./data/example_hgb/"
+INFOLDER = os.path.join(DATA, "processed")
+OUTFILE = os.path.join(DATA, "agreement.json")
+
+# Which annotators to compare, leave empty for all.
+# Set them if annotator names contain "_", the document name is taken to start after the first "_" otherwise.
+ANNOTATORS = []
+
+WORKERS = None  # number of documents compared at the same time, None uses all CPUs
+
+NS = {"b": DEFAULT_NAMESPACE}
+
+
+def read_units(root):
+    """
+    Return {layer: [(start, end, key, label)]} of a BeNASch document.
+    Only units with the same key can match (e.g. roles of the same event), the label is compared.
+    """
+    units = {}
+    extents = {}
+    for span in root.iterfind("./b:spans//b:span", NS):
+        start, end = int(span.get("start")), int(span.get("end"))
+        extents[span.get("id")] = (start, end)
+        units.setdefault(span.get("element"), []).append((start, end, "", span.get("class") or ""))
+
+    for relation in root.iterfind("./b:relations/b:relation", NS):
+        source, target = extents.get(relation.get("from")), extents.get(relation.get("to"))
+        if source is None or target is None:
+            continue
+        units.setdefault("relation", []).append((source[0], source[1], f"{target[0]}-{target[1]}", relation.get("class") or ""))
+
+    for event_group in root.iterfind("./b:eventGroups/b:eventGroup", NS):
+        trigger = event_group.find("./b:trigger", NS)
+        anchor = trigger if trigger is not None else event_group
+        if anchor.get("start") is None:
+            continue
+        start, end = int(anchor.get("start")), int(anchor.get("end"))
+        event_class = event_group.get("class") or ""
+        units.setdefault("event", []).append((start, end, "", event_class))
+        for role in event_group.iterfind("./b:event/b:role", NS):
+            extent = extents.get(role.get("ref"))
+            if extent is None:
+                continue
+            units.setdefault("role:" + role.get("role"), []).append((extent[0], extent[1], f"{event_class}@{start}-{end}", role.get("role")))
+    return units
+
+
+def count_overlaps(a_items, b_items):
+    """
+    Match overlapping (start, end) items of a and b one to one and return the number of matches.
+    The items are swept by start, an item is matched with the unmatched item of the other side
+    that ends first among those still overlapping it.
+    """
+    events = sorted([(start, end, 0) for start, end in a_items] + [(start, end, 1) for start, end in b_items])
+    open_ends = ([], [])
+    matched = 0
+    for start, end, side in events:
+        other = open_ends[1 - side]
+        while other and other[0] < start:
+            heapq.heappop(other)
+        if other:
+            heapq.heappop(other)
+            matched += 1
+        else:
+            heapq.heappush(open_ends[side], end)
+    return matched
+
+
+def compare_units(a_units, b_units):
+    """
+    Compare the units of one layer of two annotators.
+    :return: (Counter with a, b, exact and partial, Counter of (label a, label b) per position)
+    """
+    a_units = sorted(a_units)
+    b_units = sorted(b_units)
+    counts = Counter(a=len(a_units), b=len(b_units))
+    confusion = Counter()
+
+    # exact matches and the labels per position in one sweep over both sorted lists
+    a_rest, b_rest = [], []
+    i = j = 0
+    while i < len(a_units) or j < len(b_units):
+        if j == len(b_units) or (i < len(a_units) and a_units[i][:3] < b_units[j][:3]):
+            position = a_units[i][:3]
+        else:
+            position = b_units[j][:3]
+        a_labels, b_labels = [], []
+        while i < len(a_units) and a_units[i][:3] == position:
+            a_labels.append(a_units[i][3])
+            i += 1
+        while j < len(b_units) and b_units[j][:3] == position:
+            b_labels.append(b_units[j][3])
+            j += 1
+        # labels are sorted, so equal labels are paired first
+        common = Counter(a_labels) & Counter(b_labels)
+        counts["exact"] += sum(common.values())
+        a_only = sorted((Counter(a_labels) - common).elements())
+        b_only = sorted((Counter(b_labels) - common).elements())
+        for label, n in common.items():
+            confusion[label, label] += n
+        for a_label, b_label in itertools.zip_longest(a_only, b_only):
+            confusion[a_label, b_label] += 1
+        a_rest.extend(position + (label,) for label in a_only)
+        b_rest.extend(position + (label,) for label in b_only)
+
+    # partial matches among the units without an exact match, by key and label
+    groups = {}
+    for side, rest in enumerate([a_rest, b_rest]):
+        for start, end, key, label in rest:
+            groups.setdefault((key, label), ([], []))[side].append((start, end))
+    counts["partial"] = counts["exact"] + sum(count_overlaps(a_items, b_items) for a_items, b_items in groups.values())
+    return counts, confusion
+
+
+def compare_document(paths):
+    """
+    Compare all annotators of a document.
+    :param paths: {annotator: path of the processed file}
+    :return: {(layer, annotator a, annotator b): (counts, confusion)}
+    """
+    units = {annotator: read_units(parse_document(path).getroot()) for annotator, path in paths.items()}
+    results = {}
+    for a, b in itertools.combinations(sorted(units), 2):
+        for layer in set(units[a]) | set(units[b]):
+            results[layer, a, b] = compare_units(units[a].get(layer, []), units[b].get(layer, []))
+    return results
+
+
+def group_by_document(infolder, annotators=None):
+    """
+    Return a list of {annotator: path}, one per document annotated by at least two annotators.
+    """
+    documents = {}
+    for path in sorted(glob(os.path.join(infolder, "*.xml")) + glob(os.path.join(infolder, "*.xml.gz"))):
+        annotator, document = split_filename(path, annotators)
+        if annotator is None:
+            continue
+        documents.setdefault(document, {})[annotator] = path
+    return [paths for _, paths in sorted(documents.items()) if len(paths) > 1]
+
+
+def get_scores(counts, confusion):
+    n = counts["a"] + counts["b"]
+    total = sum(confusion.values())
+    kappa = None
+    if total:
+        observed = sum(n for (a_label, b_label), n in confusion.items() if a_label == b_label) / total
+        a_marginals, b_marginals = Counter(), Counter()
+        for (a_label, b_label), n_pair in confusion.items():
+            a_marginals[a_label] += n_pair
+            b_marginals[b_label] += n_pair
+        expected = sum(a_marginals[label] * b_marginals[label] for label in a_marginals) / total ** 2
+        kappa = (observed - expected) / (1 - expected) if expected < 1 else 1.0
+    return {
+        "units": n,
+        "exact_f1": 2 * counts["exact"] / n if n else None,
+        "partial_f1": 2 * counts["partial"] / n if n else None,
+        "kappa": kappa,
+    }
+
+
+def compute_agreement(documents, workers=WORKERS):
+    """
+    Compare the documents in parallel and return the scores per layer, summed over all pairs
+    of annotators, and per pair of annotators.
+    """
+    totals = {}
+    with ProcessPoolExecutor(workers) as pool:
+        for results in pool.map(compare_document, documents):
+            for (layer, a, b), (counts, confusion) in results.items():
+                for key in [(layer, None), (layer, f"{a}|{b}")]:
+                    total_counts, total_confusion = totals.setdefault(key, (Counter(), Counter()))
+                    total_counts.update(counts)
+                    total_confusion.update(confusion)
+
+    report = {"layers": {}, "pairs": {}}
+    for (layer, pair), (counts, confusion) in sorted(totals.items(), key=lambda x: (x[0][0], x[0][1] or "")):
+        if pair is None:
+            report["layers"][layer] = get_scores(counts, confusion)
+        else:
+            report["pairs"].setdefault(pair, {})[layer] = get_scores(counts, confusion)
+    return report
+
+
+if __name__ == "__main__":
+    documents = group_by_document(INFOLDER, ANNOTATORS)
+    print(f"Comparing {len(documents)} documents with at least two annotators.")
+    report = compute_agreement(documents)
+
+    def fmt(x):
+        return "-" if x is None else f"{x:.3f}"
+    print(f"{'layer':<30} {'units':>7} {'exact F1':>9} {'partial F1':>11} {'kappa':>7}")
+    for layer, scores in report["layers"].items():
+        print(f"{layer:<30} {scores['units']:>7} {fmt(scores['exact_f1']):>9} {fmt(scores['partial_f1']):>11} {fmt(scores['kappa']):>7}")
+
+    with open(OUTFILE, "w", encoding="utf8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"See the agreement per pair of annotators at {os.path.abspath(OUTFILE)}")
@@ -0,0 +1,81 @@
+"""
+Microbenchmark for the SpanRegistry in postprocess.py.
+Compares the span scans the processing steps used to do on the work tree
+(findall/xpath over all spans, id lookups with find) with one SpanRegistry
+that is built once and iterated by every step.
+"""
+
+import glob
+import os
+import timeit
+
+from lxml import etree as et
+
+import postprocess
+from diagnostics import Diagnostics
+
+
+# SET PATH TO RELEVANT CORPUS FOLDER
+DATA = "./data/example_hgb/"
+UNZIPPED = os.path.join(DATA, "unzipped")
+
+REPEAT = 200  # runs per document, the best of 5 rounds is reported
+
+
+def scan_tree(out_root, ids):
+    # the scans of process_spans, apply_special_operations_between_processing, write_events and cleanup
+    for _ in range(3):
+        for span in out_root.findall("./spans//span"):
+            pass
+    for span in out_root.findall("./spans//span"):
+        pass
+    out_root.xpath("./spans//span[@element='list' and not(parent::span[@element='list'])]")
+    out_root.xpath("./spans//span[string-length(@role) > 0]")
+    for element in ["interaction", "reference", "appo", "attr", "trigger"]:
+        out_root.xpath(f"./spans//span[@element='{element}']")
+    for span in out_root.find("spans").findall(".//span"):
+        pass
+    for span_id in ids:
+        out_root.find(f"./spans//span[@id='{span_id}']")
+
+
+def scan_registry(out_root, ids):
+    spans = postprocess.SpanRegistry(out_root)
+    for _ in range(4):
+        for span in spans:
+            pass
+    spans_by_element = spans.by_element()
+    [span for span in spans_by_element.get("list", []) if span.getparent().get("element") != "list"]
+    [span for span in spans if span.get("role")]
+    for element in ["interaction", "reference", "appo", "attr", "trigger"]:
+        spans_by_element.get(element, [])
+    for span in spans:
+        pass
+    for span_id in ids:
+        spans.get(span_id)
+
+
+def get_work_tree(path):
+    processor = postprocess.Processor(sink=postprocess.MemorySink(), diagnostics=Diagnostics(console_limit=0))
+    with processor.diagnostics.document(path):
+        in_root = et.parse(path).getroot()
+        if not processor.has_spans(in_root):
+            return None
+        tokens, out_root = processor.build_work_tree(in_root)
+        # the element attributes are set by process_spans
+        postprocess.process_spans(out_root, tokens.token_texts, processor.config)
+    return out_root
+
+
+if __name__ == "__main__":
+    print(f"{'document':<50} {'spans':>6} {'scans (ms)':>11} {'registry (ms)':>14} {'speedup':>8}")
+    for path in sorted(glob.glob(os.path.join(UNZIPPED, "*"))):
+        out_root = get_work_tree(path)
+        if out_root is None:
+            continue
+        # the id lookups of the relations (events from relations, role participants, coreference)
+        ids = [relation.get(attr) for relation in out_root.iterfind("./relations/relation") for attr in ["from", "to"]]
+        n_spans = sum(1 for _ in out_root.find("spans").iter("span"))
+        scans = min(timeit.repeat(lambda: scan_tree(out_root, ids), number=REPEAT, repeat=5)) / REPEAT * 1000
+        registry = min(timeit.repeat(lambda: scan_registry(out_root, ids), number=REPEAT, repeat=5)) / REPEAT * 1000
+        print(f"{os.path.basename(path):<50} {n_spans:>6} {scans:>11.3f} {registry:>14.3f} {scans / registry:>7.1f}x")
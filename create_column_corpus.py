@@ -4,26 +4,67 @@ The input files are the BeNASch formatted files.
 
 This script will also handle the resolution of a file that was annotated by more than 1 user.
 We handle it with the following solution:
-Ranking: Requires additionally a list of the user names and will take the first-named users file over latter named users files.
+Ranking: Requires additionally a list of the user names (ANNOTATOR_RANKING) and will take the first-named users file over latter named users files.
+The files are chosen by their names ({user}_{document}), the files of the other users are not read at all.
 
 This script can also automatically split your data into training, validation and test sets. 
-Please use the script TODO in the utility folder to generate a split file that will record your splits for further use.
-If you prefer your data not to be split, simply leave the path to the split file empty.
+Either set SPLIT_RATIOS, then every document is assigned to a split by a hash of its name. The assignment
+is stable, new documents get a split without changing the ones of the existing documents, so no split file is needed.
+Or set CONSISTENT_DATA to a split file that records your splits ({"train": [...], "dev": [...], "test": [...]}).
+If you prefer your data not to be split, simply leave both empty.
+
+Instead of the column format, the documents can also be written as nested spans (OUTPUT_FORMAT = "spans"):
+one JSON line per document with its tokens, the spans of each column ([start, end, label], end exclusive) and the events.
+
+For training, long samples can be split into overlapping windows (WINDOW_SIZE), and an index that groups the samples
+of each output file by length can be written (BUCKETS), so batches can be drawn from samples of similar length.
 """
 
 
+import bisect
+import gzip
+import hashlib
+import io
 import json
 import os
+import shutil
+from collections import Counter
 from glob import glob
 import pathlib
-from transformation.to_column import process_document
+import zipfile
+from transformation import to_column, to_spans
+from transformation.to_column import check_window_options, scan_labels
+from unzip_export import split_filename
 
 
 ### SETTINGS ###
 DATA = "./data/gewerbuecher_2026_02_18/"
-INFOLDER = os.path.join(DATA, "processed")
+INFOLDER = os.path.join(DATA, "processed")  # can also be a corpus archive written by postprocess (e.g. processed.zip)
 OUTFOLDER = os.path.join(DATA, "all_spans")
 CONSISTENT_DATA = ""
+# e.g. {"train": 0.8, "dev": 0.1, "test": 0.1} splits the documents by a hash of their name (ignored if CONSISTENT_DATA is set)
+SPLIT_RATIOS = {}
+# True splits the documents by a hash of the label they mention least often and their name, and reports labels missing from a split.
+# This needs a quick scan of all documents first. The split of a document stays the same when documents are added.
+STRATIFY = False
+# set a folder to keep the converted documents in (e.g. os.path.join(OUTFOLDER, "shards")), reruns then only convert
+# documents whose file or PROCESSING_CONFIG changed and put the split files together from the kept documents
+SHARDS = ""
+# "column" writes IOB samples ({split}.txt), "spans" writes one JSON line per document with nested spans and events ({split}.jsonl)
+OUTPUT_FORMAT = "column"
+# split samples longer than WINDOW_SIZE tokens into windows that share up to WINDOW_OVERLAP tokens (column format only).
+# Spans cut off at the start of a window begin there (B-). 0 writes every sample whole.
+WINDOW_SIZE = 0
+WINDOW_OVERLAP = 0
+# True ends the windows at line breaks where possible, longer lines are split. The line breaks are only known for documents
+# written with TOKEN_STORAGE = "standoff" in postprocess (or with line elements), other documents are cut at the window size.
+WINDOW_AT_LINES = False
+# sample lengths (tokens) to group the samples by, e.g. [32, 64, 128, 256, 512]. Writes an index ({split}.buckets.json)
+# next to every output file with the byte offset and length of each sample and the samples of each bucket. Leave empty for no index.
+BUCKETS = []
+# ranked user names, for documents annotated by more than one user only the file of the first-named user is used
+# files of users not in the list are skipped. Leave empty to use all files.
+ANNOTATOR_RANKING = []
 
 
 ### PROCESSING CONGIG ###
@@ -60,54 +101,388 @@ PROCESSING_CONFIG = {
     }
 }
 
+# named variants of the config, e.g. {"all_spans": PROCESSING_CONFIG, "references": {...}}. The corpus is read once for all
+# variants and each is written to its own subfolder of OUTFOLDER. Leave empty to only use PROCESSING_CONFIG.
+PROCESSING_CONFIGS = {}
+
+# output format -> (conversion module, extension of the output files)
+CONVERTERS = {
+    "column": (to_column, ".txt"),
+    "spans": (to_spans, ".jsonl"),
+}
+
+
+def iter_documents(infolder, names=None):
+    """
+    Yield (path, document) for the processed documents in infolder.
+    infolder can either be a folder of .xml/.xml.gz files or a corpus archive (.zip) written by postprocess.
+    Archive members are read in archive order, or by name if names are given, without extracting them to disk.
+    """
+    if os.path.isfile(infolder) and zipfile.is_zipfile(infolder):
+        with zipfile.ZipFile(infolder, "r") as archive:
+            if names is None:
+                names = [n for n in archive.namelist() if n.endswith((".xml", ".xml.gz"))]
+            for name in names:
+                with archive.open(name) as member:
+                    yield os.path.join(infolder, name), member
+    else:
+        if names is None:
+            infiles = sorted(glob(os.path.join(infolder, "*.xml")) + glob(os.path.join(infolder, "*.xml.gz")))
+        else:
+            infiles = [os.path.join(infolder, n) for n in names]
+        for infile in infiles:
+            yield infile, infile
+
+
+def list_documents(infolder):
+    """
+    Return the names of the processed documents in infolder (a folder or a corpus archive) without reading them.
+    """
+    if os.path.isfile(infolder) and zipfile.is_zipfile(infolder):
+        with zipfile.ZipFile(infolder, "r") as archive:
+            return [n for n in archive.namelist() if n.endswith((".xml", ".xml.gz"))]
+    return sorted(os.path.basename(p) for p in glob(os.path.join(infolder, "*.xml")) + glob(os.path.join(infolder, "*.xml.gz")))
+
+
+def resolve_annotators(names, ranking):
+    """
+    Keep one file per document: the one of the highest ranked user.
+    :param names: The file names ({user}_{document}).
+    :param ranking: The user names, highest ranked first.
+    """
+    rank = {user: i for i, user in enumerate(ranking)}
+    chosen = {}
+    for name in names:
+        user, document = split_filename(name, ranking)
+        if user is None:
+            print(f"WARNING! {name} was not annotated by a ranked user, skipping it.")
+            continue
+        if document not in chosen or rank[user] < rank[chosen[document][0]]:
+            chosen[document] = (user, name)
+    return sorted(name for _, name in chosen.values())
+
+
+def get_document_id(name, ranking=None):
+    """
+    Return the name the document is split by, without the user if the file was chosen by ranking.
+    """
+    basename = os.path.basename(name)
+    if basename.endswith(".gz"):
+        basename = basename[:-len(".gz")]  # compressed files are registered under their plain name
+    if ranking:
+        _, basename = split_filename(basename, ranking)
+    return basename
+
+
+def hash_fraction(document_id):
+    """
+    Map the document id to a number in [0, 1), the same on every run and machine.
+    """
+    return int(hashlib.sha256(document_id.encode("utf8")).hexdigest()[:16], 16) / 16**16
+
+
+def hash_split(document_id, ratios):
+    x = hash_fraction(document_id) * sum(ratios.values())
+    for split, ratio in ratios.items():
+        if x < ratio:
+            return split
+        x -= ratio
+    return split
+
+
+def stratified_split(labels, ratios):
+    """
+    Split the documents by a hash of their group and their id. The group is the label a document mentions least often,
+    so the split of a document only depends on the document itself and stays the same when documents are added.
+    Labels that no document of a split has are reported.
+    :param labels: {document id: Counter of the labels of the document}
+    :return: {document id: split}
+    """
+    splits = {}
+    split_labels = {split: set() for split in ratios}
+    for document_id, counts in labels.items():
+        group = min(counts, key=lambda label: (counts[label], label)) if counts else ""
+        split = hash_split(group + "/" + document_id, ratios)
+        splits[document_id] = split
+        split_labels[split].update(counts)
+    all_labels = set().union(*split_labels.values())
+    for split, found in split_labels.items():
+        if all_labels - found:
+            print(f"WARNING! No document in {split} has the labels {sorted(all_labels - found)}.")
+    return splits
+
+
+def format_document(basename, outstring):
+    if isinstance(outstring, dict):
+        # nested spans, one line per document
+        return json.dumps({"document": basename, **outstring}, ensure_ascii=False) + "\n"
+    # write the filename as a comment (flair ignores these in ColumnCorpus)
+    if not outstring:
+        return ""
+    return f"# {basename}\n{outstring}\n"
+
+
+def get_processing_config_hash(config, output_format="column", options=None):
+    """
+    Hash the processing config, the output format, the options of the conversion (e.g. windows) and the code of the conversion,
+    the kept documents are converted again if any of them changes.
+    """
+    h = hashlib.sha256(json.dumps([config, output_format, options or {}], sort_keys=True).encode("utf8"))
+    # in a fixed order, the order of a set of modules changes from run to run
+    for module in dict.fromkeys([to_column, CONVERTERS[output_format][0]]):
+        with open(module.__file__, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
 
-def main(infolder, outfolder, training_splits, config=None):
-    pathlib.Path(outfolder).mkdir(parents=True, exist_ok=True) 
+def read_manifest(shard_folder):
+    manifest_path = os.path.join(shard_folder, "manifest.json")
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, mode="r", encoding="utf8") as f:
+        return json.load(f)
 
-    infiles = sorted(glob(os.path.join(infolder, "*.xml")))
 
-    tagset = set()
+def write_manifest(shard_folder, manifest):
+    manifest_path = os.path.join(shard_folder, "manifest.json")
+    with open(manifest_path + ".part", mode="w", encoding="utf8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(manifest_path + ".part", manifest_path)
 
+
+def update_shards(infolder, names, configs, shard_folders, with_labels=False, output_format="column", options=None):
+    """
+    Keep every converted document in its own file (shard), with a manifest per shard folder recording
+    the hash of the processed file and of the config it was converted from.
+    Only documents that are new or changed are converted, shards of documents that are gone are removed.
+    :param configs: {variant: config}
+    :param shard_folders: {variant: folder the shards of the variant are kept in}
+    :param options: Keyword arguments for process_document of the converter.
+    :return: [(infile, {variant: (path of the shard, tags)}, label counts)] in document order, label counts only if with_labels.
+    """
+    manifests = {}
+    config_hashes = {}
+    for variant, shard_folder in shard_folders.items():
+        pathlib.Path(shard_folder).mkdir(parents=True, exist_ok=True)
+        manifests[variant] = read_manifest(shard_folder)
+        config_hashes[variant] = get_processing_config_hash(configs[variant], output_format, options)
+    converter, extension = CONVERTERS[output_format]
+
+    new_manifests = {variant: {} for variant in configs}
+    documents = []
+    converted = 0
+    for infile, document in iter_documents(infolder, names):
+        if hasattr(document, "read"):
+            data = document.read()
+        else:
+            with open(document, "rb") as f:
+                data = f.read()
+        file_hash = hashlib.sha256(data).hexdigest()
+        basename = get_document_id(infile)
+        if infile.endswith(".gz"):
+            data = gzip.decompress(data)
+
+        entries = {variant: manifests[variant].get(basename) for variant in configs}
+        outdated = [variant for variant, entry in entries.items()
+                    if entry is None or entry["hash"] != file_hash or entry["config"] != config_hashes[variant]
+                    or not os.path.exists(os.path.join(shard_folders[variant], entry["shard"]))]
+        if outdated:
+            print(f"Processing {infile}...")
+            # the document is parsed once for all variants that have to be converted
+            results = converter.process_document(io.BytesIO(data), configs={variant: configs[variant] for variant in outdated}, **(options or {}))
+            for variant, (outstring, tags) in results.items():
+                entries[variant] = {
+                    "hash": file_hash,
+                    "config": config_hashes[variant],
+                    "shard": basename + extension,
+                    "tags": sorted(tags),
+                    "labels": None,
+                }
+                with open(os.path.join(shard_folders[variant], entries[variant]["shard"]), mode="w", encoding="utf8") as f:
+                    f.write(format_document(basename, outstring))
+            converted += 1
+
+        labels = None
+        if with_labels:
+            # the labels only depend on the file, all variants keep the same counts
+            labels = next((entry["labels"] for entry in entries.values() if entry["labels"] is not None), None)
+            if labels is None:
+                labels = dict(scan_labels(io.BytesIO(data)))
+            for entry in entries.values():
+                entry["labels"] = labels
+            labels = Counter(labels)
+
+        for variant, entry in entries.items():
+            new_manifests[variant][basename] = entry
+        documents.append((infile, {variant: (os.path.join(shard_folders[variant], entry["shard"]), entry["tags"]) for variant, entry in entries.items()}, labels))
+
+    for variant, shard_folder in shard_folders.items():
+        for basename, entry in manifests[variant].items():
+            if basename not in new_manifests[variant] and os.path.exists(os.path.join(shard_folder, entry["shard"])):
+                os.remove(os.path.join(shard_folder, entry["shard"]))
+        write_manifest(shard_folder, new_manifests[variant])
+
+    print(f"Converted {converted} of {len(documents)} documents, the others were unchanged.")
+    return documents
+
+
+def write_bucket_index(path, buckets):
+    """
+    Write the index of an output file to {split}.buckets.json: "samples" holds the byte offset (of the first row or line)
+    and the length of each sample in file order, "buckets" the samples of each length bucket in file order.
+    The length is the number of tokens of a column sample (without the [B-...]/[E-...] rows of the base span),
+    or of a document in nested spans.
+    A sample goes to the first bucket that is at least as long, longer samples to the last bucket (">{longest}").
+    """
+    samples = []
+    offset = 0
+    with open(path, "rb") as f:
+        if path.endswith(".jsonl"):
+            for line in f:
+                samples.append([offset, len(json.loads(line)["tokens"])])
+                offset += len(line)
+        else:
+            sample_start, tokens = None, 0
+            for line in f:
+                if not line.strip():
+                    if sample_start is not None:
+                        samples.append([sample_start, tokens])
+                    sample_start, tokens = None, 0
+                elif sample_start is None and line.startswith(b"# "):
+                    pass  # the comment with the name of the document
+                else:
+                    if sample_start is None:
+                        sample_start = offset
+                        if line.startswith(b"[B-"):
+                            tokens -= 2  # the first and the last row mark the base span
+                    tokens += 1
+                offset += len(line)
+            if sample_start is not None:
+                samples.append([sample_start, tokens])
+
+    buckets = sorted(buckets)
+    index = {str(bucket): [] for bucket in buckets}
+    index[f">{buckets[-1]}"] = []
+    for i, (_, length) in enumerate(samples):
+        j = bisect.bisect_left(buckets, length)
+        index[str(buckets[j]) if j < len(buckets) else f">{buckets[-1]}"].append(i)
+
+    index_path = os.path.splitext(path)[0] + ".buckets.json"
+    with open(index_path, mode="w", encoding="utf8") as f:
+        json.dump({"samples": samples, "buckets": index}, f)
+
+
+def main(infolder, outfolder, training_splits, config=None, ranking=None, split_ratios=None, stratify=False, shard_folder=None, configs=None,
+         output_format="column", window_size=0, window_overlap=0, window_at_lines=False, buckets=None):
+    """
+    :param configs: Named configs ({variant: config}), all are converted in one pass over the corpus and each variant
+        is written to its own subfolder of outfolder (and of shard_folder). config is ignored if they are given.
+    :param output_format: A key of CONVERTERS.
+    :param buckets: Sample lengths to write a bucket index for (see write_bucket_index).
+    """
+    converter, extension = CONVERTERS[output_format]
+    options = {}
+    if window_size:
+        if output_format == "column":
+            check_window_options(window_size, window_overlap)
+            options = {"window_size": window_size, "window_overlap": window_overlap, "window_at_lines": window_at_lines}
+        else:
+            print(f"WARNING! Windows are only written in the column format, the {output_format} output is not split.")
+    if configs:
+        outfolders = {variant: os.path.join(outfolder, variant) for variant in configs}
+        shard_folders = {variant: os.path.join(shard_folder, variant) for variant in configs} if shard_folder else None
+    else:
+        configs = {None: config}
+        outfolders = {None: outfolder}
+        shard_folders = {None: shard_folder} if shard_folder else None
+
+    consistent_data = None
     if training_splits:
-        trainfile = open(os.path.join(outfolder, "train.txt"), mode="w", encoding="utf8")
-        devfile = open(os.path.join(outfolder, "dev.txt"), mode="w", encoding="utf8")
-        testfile = open(os.path.join(outfolder, "test.txt"), mode="w", encoding="utf8")
+        split_names = ["train", "dev", "test"]
         with open(training_splits, mode="r", encoding="utf8") as cons:
             consistent_data = json.load(cons)
+    elif split_ratios:
+        split_names = list(split_ratios)
     else:
-        writer = open(os.path.join(outfolder, "columns.txt"), mode="w", encoding="utf8")
-        consistent_data = None
-
-    for infile in infiles:
-        print(f"Processing {infile}...")
-        outstring, tags = process_document(infile, config=config)
-        tagset.update(tags)
-        basename = os.path.basename(infile)
-        
+        split_names = ["columns"]
+
+    tagsets = {}
+    split_files = {}
+    for variant, variant_outfolder in outfolders.items():
+        pathlib.Path(variant_outfolder).mkdir(parents=True, exist_ok=True)
+        tagsets[variant] = set()
+        split_files[variant] = {split: open(os.path.join(variant_outfolder, split + extension), mode="w", encoding="utf8") for split in split_names}
+
+    names = None
+    if ranking:
+        all_names = list_documents(infolder)
+        names = resolve_annotators(all_names, ranking)
+        print(f"Using {len(names)} of {len(all_names)} files after resolving documents annotated by more than one user.")
+
+    documents = None
+    if shard_folders:
+        documents = update_shards(infolder, names, configs, shard_folders, with_labels=bool(not training_splits and split_ratios and stratify),
+                                  output_format=output_format, options=options)
+
+    stratified_splits = None
+    if not training_splits and split_ratios and stratify:
+        if documents is not None:
+            labels = {get_document_id(infile, ranking): label_counts for infile, _, label_counts in documents}
+        else:
+            labels = {get_document_id(infile, ranking): scan_labels(document) for infile, document in iter_documents(infolder, names)}
+        stratified_splits = stratified_split(labels, split_ratios)
+
+    def get_split(infile):
         if consistent_data is not None:
+            basename = get_document_id(infile)
             if basename in consistent_data["test"]:
-                writer = testfile
+                return "test"
             elif basename in consistent_data["dev"]:
-                writer = devfile
+                return "dev"
             elif basename in consistent_data["train"]:
-                writer = trainfile
+                return "train"
             else:
                 print(f"WARNING! {infile} was not found in consistent training registry!")
-                continue
-
-        # write the filename as a comment (flair ignores these in ColumnCorpus)
-        if outstring:
-            writer.write(f"# {os.path.basename(infile)}\n")
-            writer.write(outstring)
-            writer.write("\n")
+                return None
+        elif stratified_splits is not None:
+            return stratified_splits[get_document_id(infile, ranking)]
+        elif split_ratios:
+            return hash_split(get_document_id(infile, ranking), split_ratios)
+        return "columns"
 
-    if training_splits:
-        trainfile.close()
-        devfile.close()
-        testfile.close()
+    if documents is not None:
+        # the split files are put together from the shards
+        for infile, shards, _ in documents:
+            split = get_split(infile)
+            for variant, (shard_path, tags) in shards.items():
+                tagsets[variant].update(tags)
+                if split is None:
+                    continue
+                with open(shard_path, mode="r", encoding="utf8") as shard:
+                    shutil.copyfileobj(shard, split_files[variant][split])
+    else:
+        for infile, document in iter_documents(infolder, names):
+            print(f"Processing {infile}...")
+            results = converter.process_document(document, configs=configs, **options)
+            split = get_split(infile)
+            for variant, (outstring, tags) in results.items():
+                tagsets[variant].update(tags)
+                if split is None:
+                    continue
+                split_files[variant][split].write(format_document(get_document_id(infile), outstring))
 
-    print("Tags in the dataset:", sorted(tagset))
+    for variant, files in split_files.items():
+        for f in files.values():
+            f.close()
+            if buckets:
+                write_bucket_index(f.name, buckets)
+        if variant is None:
+            print("Tags in the dataset:", sorted(tagsets[variant]))
+        else:
+            print(f"Tags in {variant}:", sorted(tagsets[variant]))
 
 
 if __name__ == "__main__":
-    main(INFOLDER, OUTFOLDER, CONSISTENT_DATA, config=PROCESSING_CONFIG)
+    main(INFOLDER, OUTFOLDER, CONSISTENT_DATA, config=PROCESSING_CONFIG, ranking=ANNOTATOR_RANKING, split_ratios=SPLIT_RATIOS, stratify=STRATIFY,
+         shard_folder=SHARDS, configs=PROCESSING_CONFIGS, output_format=OUTPUT_FORMAT, window_size=WINDOW_SIZE, window_overlap=WINDOW_OVERLAP,
+         window_at_lines=WINDOW_AT_LINES, buckets=BUCKETS)
@@ -0,0 +1,156 @@
+"""
+Collects the warnings and errors reported while postprocessing.
+Every message has a code (the kind of message), a severity, the document and the id of the
+span (or relation, event) it is about, so the messages of a whole batch can be counted and
+filtered instead of scrolling through the console output.
+
+The pipeline calls report(), which records the message in the collector of the document
+that is currently processed in this thread (see Diagnostics.document). Without an active
+collector, the message is just printed as before.
+"""
+
+import json
+import threading
+from collections import Counter, defaultdict, namedtuple
+
+
+CONSOLE_LIMIT = 20  # messages of the same code printed per document, the rest is only counted (None prints all)
+RECORD_LIMIT = 100  # messages of the same code kept per document, the rest is only counted (None keeps all)
+
+# code -> severity
+CODES = {
+    "token-misalignment": "warning",
+    "no-tokens": "error",
+    "overlap-repaired": "warning",
+    "overlap": "error",
+    "missing-required-field": "warning",
+    "unrecognized-information": "error",
+    "head-type-unassigned": "warning",
+    "pronoun-without-coreference": "warning",
+    "coreference-to-apposition": "warning",
+    "parent-not-found": "warning",
+    "head-supplemented": "warning",
+    "missing-head": "error",
+    "marked-span": "warning",
+    "unknown-instruction": "warning",
+    "unknown-feature-value": "warning",
+    "unnested-describing-element": "error",
+    "unknown-event-definition": "warning",
+    "unknown-role-definition": "warning",
+    "event-cycle": "error",
+    "multiple-triggers": "error",
+    "unmatched-role": "error",
+    "unknown-special-operation": "error",
+    "unknown-event-config": "warning",
+    "unknown-role-config": "warning",
+    "role-class-not-allowed": "warning",
+    "dangling-reference": "warning",
+    "dangling-relation": "error",
+    "processing-failed": "error",
+}
+
+Diagnostic = namedtuple("Diagnostic", ["code", "severity", "document", "span_id", "message"])
+
+_active = threading.local()  # the collector and document of the current thread
+
+
+class Diagnostics:
+    """
+    Collects the diagnostics of a run. It can be shared by several threads.
+
+    :param console_limit: Number of messages of the same code printed per document, None prints all, 0 prints none.
+    :param record_limit: Number of messages of the same code kept in records per document, None keeps all.
+        The counts (and the summary) always include all messages.
+    """
+    def __init__(self, console_limit=CONSOLE_LIMIT, record_limit=RECORD_LIMIT):
+        self.console_limit = console_limit
+        self.record_limit = record_limit
+        self.records = []
+        self.by_document = defaultdict(list)
+        self.counts = Counter()  # (document, code) -> number of messages
+        self._lock = threading.Lock()
+
+    def document(self, name):
+        """
+        Context manager, everything reported in this thread while it is active is recorded for document name.
+        """
+        return _DocumentContext(self, name)
+
+    def record(self, code, message, document=None, span_id=None):
+        severity = CODES[code]
+        with self._lock:
+            self.counts[document, code] += 1
+            count = self.counts[document, code]
+            if self.record_limit is None or count <= self.record_limit:
+                diagnostic = Diagnostic(code, severity, document, span_id, message)
+                self.records.append(diagnostic)
+                self.by_document[document].append(diagnostic)
+        if self.console_limit is None or count <= self.console_limit:
+            print(message)
+        elif self.console_limit and count == self.console_limit + 1:
+            print(f"WARNING: Further '{code}' messages for {document} are not printed, see the diagnostics summary.")
+
+    def for_document(self, document):
+        return list(self.by_document.get(document, []))
+
+    def pop_document(self, document):
+        """
+        Return the diagnostics of a document and forget them, e.g. once they were reported,
+        so a long running collector doesn't keep the messages of every document.
+        """
+        with self._lock:
+            diagnostics = self.by_document.pop(document, [])
+            if diagnostics:
+                self.records = [d for d in self.records if d.document != document]
+            for key in [key for key in self.counts if key[0] == document]:
+                del self.counts[key]
+        return diagnostics
+
+    def summary(self):
+        """
+        Return the number of messages by code and document, followed by the totals by code (document None).
+        """
+        totals = Counter()
+        lines = []
+        for (document, code), count in sorted(self.counts.items(), key=lambda x: (str(x[0][0]), x[0][1])):
+            lines.append({"document": document, "code": code, "severity": CODES[code], "count": count})
+            totals[code] += count
+        for code, count in sorted(totals.items()):
+            lines.append({"document": None, "code": code, "severity": CODES[code], "count": count})
+        return lines
+
+    def write_summary(self, path):
+        """
+        Write the summary as JSONL, one line per document and code plus one total line per code.
+        """
+        with open(path, "w", encoding="utf8") as f:
+            for line in self.summary():
+                f.write(json.dumps(line, ensure_ascii=False) + "\n")
+
+
+class _DocumentContext:
+    def __init__(self, diagnostics, name):
+        self.diagnostics = diagnostics
+        self.name = name
+
+    def __enter__(self):
+        self.previous = getattr(_active, "context", None)
+        _active.context = self
+        return self.diagnostics
+
+    def __exit__(self, *exc):
+        _active.context = self.previous
+
+
+def report(code, message, span_id=None):
+    """
+    Record a message for the document processed in this thread.
+    :param code: The kind of message, one of CODES.
+    :param message: The message as printed on the console.
+    :param span_id: The id of the span, relation or event the message is about.
+    """
+    context = getattr(_active, "context", None)
+    if context is None:
+        print(message)
+        return
+    context.diagnostics.record(code, message, context.name, span_id)
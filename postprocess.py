@@ -1,54 +1,155 @@
 # Read CAS XMI 1.1 files and enrich them with postprocessing. Output beNASch-XML.
+# Use a Processor to process documents. The module level settings and functions
+# below are kept for scripts, they use a Processor built from these settings.
 
 from lxml import etree as et
+import atexit
+import bisect
+import contextlib
+import gzip
+import hashlib
+import importlib
+import io
 import os
+import pickle
 import re
 import pathlib
-from postprocess_config import implied_interactions, layer_processing, renaming, defaults, all_interactions
-
-CONFIG = layer_processing.CONFIG
-CONFIG.update(renaming.CONFIG)
-CONFIG.update(defaults.CONFIG)
-CONFIG.update(implied_interactions.CONFIG)
-CONFIG.update(all_interactions.CONFIG)
+import sys
+import threading
+import zipfile
+from collections import deque
+from diagnostics import Diagnostics, report
+
+# the config modules are merged in this order, later modules overwrite earlier ones
+CONFIG_MODULE_NAMES = [
+    "postprocess_config.layer_processing",
+    "postprocess_config.renaming",
+    "postprocess_config.defaults",
+    "postprocess_config.implied_interactions",
+    "postprocess_config.all_interactions",
+]
+CONFIG_CACHE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".config_cache")  # compiled configs, see load_compiled_config
 
 OUTFOLDER = ""
-
-SPAN_LAYER = CONFIG["span_layer"]  # the name of the span layer in the XMI file
-RELATION_LAYER = CONFIG["relation_layer"]  # the name of the relation layer in the XMI file
+NAMESPACE = "https://dhbern.github.io/BeNASch/ns"
+PRETTY_PRINT = True  # False writes compact XML without indentation
+COMPRESSION = 0  # gzip compression level (1-9) of the output files, 0 writes plain XML
+TOKEN_STORAGE = "elements"  # "standoff" writes the text once plus a table of token offsets instead of one element per token
+WRITE_SPAN_TEXT = True  # False drops the text attributes of spans, triggers and roles (they can be rebuilt from the tokens)
+ARCHIVE = ""  # path to a zip file, if set all processed documents are written into it instead of single files in OUTFOLDER
+WORK_TREE_CACHE = ""  # folder to cache the work tree of every document in, reruns then start at process_spans (see Processor)
+
+_default_processor = None  # the Processor used by the module level functions, see get_default_processor
+_default_settings = None
+_default_lock = threading.Lock()
 
 DEBUG = True  # True writes the work trees to files
 DEBUGFOLDER = "./data/debug/"
 
-def write_text(text_elem, text, in_root):
+
+def get_config_paths():
+    return [os.path.join(os.path.dirname(os.path.abspath(__file__)), *name.split(".")) + ".py" for name in CONFIG_MODULE_NAMES]
+
+
+def get_config_modules():
+    """
+    Import the config modules. Modules that were already imported are reloaded, so changes on disk are picked up.
+    """
+    return [importlib.reload(sys.modules[name]) if name in sys.modules else importlib.import_module(name) for name in CONFIG_MODULE_NAMES]
+
+
+def load_config(modules=None):
+    """
+    Merge the CONFIG dictionaries of the config modules, later modules overwrite earlier ones.
+    """
+    if modules is None:
+        modules = [importlib.import_module(name) for name in CONFIG_MODULE_NAMES]
+    config = {}
+    for module in modules:
+        config.update(module.CONFIG)
+    return config
+
+
+def read_token_offsets(in_root):
+    """
+    Return the sorted begin and end offsets of the tokens of the XMI. They make matching
+    the tokens to the annotations easier in the next steps.
+    """
+    tokens = in_root.findall(".//type5:Token", namespaces={"type5":"http:///de/tudarmstadt/ukp/dkpro/core/api/segmentation/type.ecore"})
+    token_begins = []
+    token_ends = []
+    for token in sorted(tokens, key=lambda x: int(x.get("begin"))):
+        token_begins.append(int(token.get("begin")))
+        token_ends.append(int(token.get("end")))
+    return token_begins, token_ends
+
+
+def write_text(text_elem, text, token_begins, token_ends, token_storage="elements"):
     """
     text string is transformed into single token elements.
     We use line elements to keep some of the original document structure intact.
-    We also return start and end dictionaries to make matching the tokens
-    to the annotations easier in the next steps.
+    We return the list of token strings, so text over a token range can be rebuilt
+    without searching the tree.
+
+    With token_storage = "standoff", no token elements are written. Instead, the text
+    is stored once in a raw element, followed by an offsets element listing the
+    begin and end character offset of every token.
 
     NOTE: THIS DOES NOT PERFORM ANY "PROPER" PREPROCESSING!
 
     TODO: How to represent sentences and line breaks in this new system? should we even keep doing it like this?
     """
-    current_index = 0
-    start_index_dict = {}
-    end_index_dict = {}
+    token_texts = []
+    standoff = token_storage == "standoff"
+
+    for current_index, (start, end) in enumerate(zip(token_begins, token_ends)):
+        if standoff:
+            token_texts.append(text[start:end])
+        else:
+            token_elem = et.SubElement(text_elem, "token", token_id=str(current_index))
+            token_elem.text = text[start:end]
+            token_texts.append(token_elem.text)
+
+    if standoff:
+        text_elem.set("storage", "standoff")
+        et.SubElement(text_elem, "raw").text = text
+        et.SubElement(text_elem, "offsets").text = " ".join(f"{b} {e}" for b, e in zip(token_begins, token_ends))
+
+    return token_texts
 
-    tokens = in_root.findall(".//type5:Token", namespaces={"type5":"http:///de/tudarmstadt/ukp/dkpro/core/api/segmentation/type.ecore"})
-    for token in sorted(tokens, key=lambda x: int(x.get("begin"))):
-        start = int(token.get("begin"))
-        end = int(token.get("end"))
-        token_elem = et.SubElement(text_elem, "token", token_id=str(current_index))
-        token_elem.text = text[start:end]
-        start_index_dict[start] = current_index
-        end_index_dict[end] = current_index
-        current_index += 1
 
-    return start_index_dict, end_index_dict
+class TokenLayer:
+    """
+    The text and the tokens of a document. They are the same for all annotators of a document,
+    so they are only read once when the annotations of a document are processed together
+    (see Processor.process_xmi_group). Not meant to be shared between threads.
+    """
+    def __init__(self, document_text, token_begins, token_ends):
+        self.document_text = document_text
+        self.token_begins = token_begins
+        self.token_ends = token_ends
+        self.token_texts = [document_text[begin:end] for begin, end in zip(token_begins, token_ends)]
+        self._text_elements = {}
+
+    @classmethod
+    def from_xmi(cls, in_root):
+        text_node = in_root.find("./cas:Sofa", namespaces={"cas":"http:///uima/cas.ecore"})
+        return cls(text_node.get("sofaString"), *read_token_offsets(in_root))
+
+    def text_element(self, token_storage="elements", pretty_print=True):
+        """
+        Return the text section of the output, it is only built once and reused for every annotator.
+        (pretty_print is part of the key because write_section indents the section.)
+        """
+        key = (token_storage, pretty_print)
+        if key not in self._text_elements:
+            text_elem = et.Element("text")
+            write_text(text_elem, self.document_text, self.token_begins, self.token_ends, token_storage)
+            self._text_elements[key] = text_elem
+        return self._text_elements[key]
 
 
-def get_node_priority(node):
+def get_node_priority(node, config):
     """
     This makes sure that when sorting the spans, desc-spans will be processed BEFORE 
     mentions, values, etc. 
@@ -58,34 +159,46 @@ def get_node_priority(node):
     This function may need expansion later on if more such cases exist.
     """
     try:
-        l = node.get(CONFIG["priority_layer"]).lower().split(".")[0]
+        l = node.get(config["priority_layer"]).lower().split(".")[0]
     except:
-        return CONFIG["priorities"]["default"]
-    if l in CONFIG["priorities"]:
-        return CONFIG["priorities"][l]
+        return config["priorities"]["default"]
+    if l in config["priorities"]:
+        return config["priorities"][l]
     else:
-        return CONFIG["priorities"]["default"]
+        return config["priorities"]["default"]
     
 
-def convert_char_to_token_idx(start_index_dict, end_index_dict, start, end, entity):
-    # transform character index to token index
-    token_start = start_index_dict[start]
-    #try:
-    token_end = end_index_dict[end]
-    """
-    except KeyError:
-        # Inception performs an implicit tokenization, which allows annotations
-        # to be set outside our own preprocessing. This can lead to annotations
-        # ending inside tokens as defined by our preprocessing/system
-        # to circumvent this problem, we simply stretch the tag to the end of the token
-        guard = 10000
-        while end not in end_index_dict and guard > 0:
-            end += 1
-            guard -= 1
-        token_end = end_index_dict[end]
-        
-        print(f"WARNING: An annotation ended inside a token. Check this error manually for annotation with id {entity.get('{http://www.omg.org/XMI}id')}!")
+def convert_char_to_token_idx(token_begins, token_ends, start, end, entity):
     """
+    Transform character indices to token indices.
+    Inception performs an implicit tokenization, which allows annotations
+    to be set outside our own preprocessing. This can lead to annotations
+    beginning or ending inside tokens as defined by our preprocessing/system.
+    To circumvent this problem, we look the boundaries up in the sorted token offsets
+    and snap them to the enclosing token (or to the nearest token inside the
+    annotation if they fall between two tokens), printing one warning per annotation.
+    Returns None if the document has no tokens to snap to.
+    """
+    if not token_begins:
+        report("no-tokens", f"ERROR: The document has no tokens, annotation with id {entity.get('{http://www.omg.org/XMI}id')} is skipped.", entity.get("{http://www.omg.org/XMI}id"))
+        return None
+    token_start = bisect.bisect_right(token_begins, start) - 1
+    if token_start < 0 or (token_begins[token_start] != start and token_ends[token_start] <= start):
+        token_start += 1  # start lies before the first token or between two tokens
+    token_start = min(token_start, len(token_begins) - 1)
+
+    token_end = bisect.bisect_left(token_ends, end)
+    if token_end == len(token_ends) or token_begins[token_end] >= end:
+        token_end -= 1  # end lies after the last token or between two tokens
+    token_end = max(token_end, token_start)
+
+    snapped = []
+    if token_begins[token_start] != start:
+        snapped.append("begin")
+    if token_ends[token_end] != end:
+        snapped.append("end")
+    if snapped:
+        report("token-misalignment", f"WARNING: An annotation did not align with the tokens at its {' and '.join(snapped)} and was snapped to the nearest token. Check this error manually for annotation with id {entity.get('{http://www.omg.org/XMI}id')}!", entity.get("{http://www.omg.org/XMI}id"))
     return token_start, token_end
 
 
@@ -112,80 +225,138 @@ def check_overlaps(spans):
                     # overlap detected, check length
                     if begin - other_begin == 1:
                         span.set("begin", str(other_begin))
-                        print(f"WARNING: Overlap detected between spans {span.get('{http://www.omg.org/XMI}id')} and {other_span.get('{http://www.omg.org/XMI}id')}. Overlap is only length 1, trying to fix it.")
+                        report("overlap-repaired", f"WARNING: Overlap detected between spans {span.get('{http://www.omg.org/XMI}id')} and {other_span.get('{http://www.omg.org/XMI}id')}. Overlap is only length 1, trying to fix it.", span.get("{http://www.omg.org/XMI}id"))
                     elif end - other_end == 1:
                         span.set("end", str(other_end))
-                        print(f"WARNING: Overlap detected between spans {span.get('{http://www.omg.org/XMI}id')} and {other_span.get('{http://www.omg.org/XMI}id')}. Overlap is only length 1, trying to fix it.")
+                        report("overlap-repaired", f"WARNING: Overlap detected between spans {span.get('{http://www.omg.org/XMI}id')} and {other_span.get('{http://www.omg.org/XMI}id')}. Overlap is only length 1, trying to fix it.", span.get("{http://www.omg.org/XMI}id"))
                     else:
-                        print(f"ERROR: Overlap detected between spans {span.get('{http://www.omg.org/XMI}id')} and {other_span.get('{http://www.omg.org/XMI}id')}. This will likely lead to unexpected behaviour down the line.")
+                        report("overlap", f"ERROR: Overlap detected between spans {span.get('{http://www.omg.org/XMI}id')} and {other_span.get('{http://www.omg.org/XMI}id')}. This will likely lead to unexpected behaviour down the line.", span.get("{http://www.omg.org/XMI}id"))
             elif other_begin > begin and other_begin <= end:
                 if other_end > end:
                     # overlap detected, check length
                     if other_begin - begin == 1:
                         other_span.set("begin", str(begin))
-                        print(f"WARNING: Overlap detected between spans {span.get('{http://www.omg.org/XMI}id')} and {other_span.get('{http://www.omg.org/XMI}id')}. Overlap is only length 1, trying to fix it.")
+                        report("overlap-repaired", f"WARNING: Overlap detected between spans {span.get('{http://www.omg.org/XMI}id')} and {other_span.get('{http://www.omg.org/XMI}id')}. Overlap is only length 1, trying to fix it.", span.get("{http://www.omg.org/XMI}id"))
                     elif other_end - end == 1:
                         other_span.set("end", str(end))
-                        print(f"WARNING: Overlap detected between spans {span.get('{http://www.omg.org/XMI}id')} and {other_span.get('{http://www.omg.org/XMI}id')}. Overlap is only length 1, trying to fix it.")
+                        report("overlap-repaired", f"WARNING: Overlap detected between spans {span.get('{http://www.omg.org/XMI}id')} and {other_span.get('{http://www.omg.org/XMI}id')}. Overlap is only length 1, trying to fix it.", span.get("{http://www.omg.org/XMI}id"))
                     else:
-                        print(f"ERROR: Overlap detected between spans {span.get('{http://www.omg.org/XMI}id')} and {other_span.get('{http://www.omg.org/XMI}id')}. This will likely lead to unexpected behaviour down the line.")
+                        report("overlap", f"ERROR: Overlap detected between spans {span.get('{http://www.omg.org/XMI}id')} and {other_span.get('{http://www.omg.org/XMI}id')}. This will likely lead to unexpected behaviour down the line.", span.get("{http://www.omg.org/XMI}id"))
 
 
-def create_work_tree(in_root, out_root, document_text, start_index_dict, end_index_dict):
+class SpanRegistry:
+    """
+    All spans of the work tree in document order, with an index by id.
+    The processing steps iterate over this list instead of searching the tree with findall/xpath every time.
+    Spans added to the tree (e.g. supplemented heads) have to be registered with add.
+    No processing step removes spans, so the registry doesn't support removing them.
+    """
+    def __init__(self, out_root):
+        self.spans = list(out_root.find("spans").iter("span"))
+        self.ids = {}
+        for span in self.spans:
+            self.ids.setdefault(span.get("id"), span)
+        self._pending = {}  # span -> spans added right after it in document order, merged into self.spans by the next iteration
+
+    def __iter__(self):
+        # spans added during an iteration are only seen by the next one, like with a findall list
+        if self._pending:
+            self._update()
+        return iter(self.spans)
+
+    def get(self, span_id):
+        return self.ids.get(span_id)
+
+    def by_element(self):
+        """
+        Return the spans grouped by their element attribute, each list in document order.
+        """
+        groups = {}
+        for span in self:
+            groups.setdefault(span.get("element"), []).append(span)
+        return groups
+
+    def add(self, span):
+        """
+        Register a span that was just added to the tree as the last child of its parent.
+        """
+        # the span follows the last span nested in its previous sibling, or its parent
+        anchor = span.getprevious()
+        if anchor is None:
+            anchor = span.getparent()
+        else:
+            while len(anchor) and anchor[-1].tag == "span":
+                anchor = anchor[-1]
+        if anchor.tag != "span":
+            anchor = None  # first span of the spans section
+        # a span added later at the same place is nested deeper in the earlier one's parent, so it comes first
+        self._pending.setdefault(anchor, []).insert(0, span)
+        self.ids.setdefault(span.get("id"), span)
+
+    def _update(self):
+        spans = []
+        def append(span):
+            spans.append(span)
+            for added in self._pending.pop(span, []):
+                append(added)
+        for added in self._pending.pop(None, []):
+            append(added)
+        for span in self.spans:
+            append(span)
+        self.spans = spans
+        self._pending = {}
+
+
+def create_work_tree(in_root, out_root, document_text, token_begins, token_ends, config):
     """
     Build a hierarchical tree from all spans in the XMI.
     """
-    spans = in_root.findall(f"./custom:{SPAN_LAYER}", namespaces={"custom":"http:///custom.ecore"})
+    spans = in_root.findall(f"./custom:{config['span_layer']}", namespaces={"custom":"http:///custom.ecore"})
 
     # check for and fix overlapping tags
     check_overlaps(spans)
 
     sorted_spans = []
     for ent in spans:
-        sorted_spans.append((ent, int(ent.get("begin")), int(ent.get("end")), get_node_priority(ent)))
+        sorted_spans.append((ent, int(ent.get("begin")), int(ent.get("end")), get_node_priority(ent, config)))
     sorted_spans.sort(key=lambda x: (x[1], -x[2], x[3]))
     work_root = out_root
 
+    # the feature extraction is compiled with the config, see build_lookup_tables
+    span_features = config["compiled"]["span_fields"]
+
     spans_node = et.SubElement(work_root, "spans")
-    parent_node = spans_node
+    # stack of (node, token end) of all spans enclosing the current position
+    stack = []
 
     for entity, start, end, _ in sorted_spans:
         text_content = document_text[start:end]
-        start, end = convert_char_to_token_idx(start_index_dict, end_index_dict, start, end, entity)
-
-        while(parent_node != spans_node):
-            if end <= int(parent_node.get("end")):
-                current_node = et.SubElement(parent_node, "span", id=entity.get("{http://www.omg.org/XMI}id"), start=str(start), end=str(end), text=text_content)
-                for fo, fn in CONFIG["span_features"].items():
-                    field, required = fn["field"], fn["required"]
-                    if isinstance(field, list):
-                        field = ".".join([entity.get(x) for x in field if entity.get(x) is not None])  # in inception, it's more practical to split them, but not here
-                    else:
-                        field = entity.get(field)
-                    if not field and required:
-                        print(f"WARNING: Missing required fields {fn['field']} for entity {entity.get('{http://www.omg.org/XMI}id')}!")
-                        current_node.set(fo, "other")
-                    elif field:
-                        current_node.set(fo, field.lower())
-                break
+        token_idx = convert_char_to_token_idx(token_begins, token_ends, start, end, entity)
+        if token_idx is None:
+            continue
+        start, end = token_idx
+
+        # spans are sorted by start, so every span on the stack ending before this one is closed for good
+        while stack and end > stack[-1][1]:
+            stack.pop()
+        parent_node = stack[-1][0] if stack else spans_node
+
+        entity_id = entity.get("{http://www.omg.org/XMI}id")
+        current_node = et.SubElement(parent_node, "span", id=entity_id, start=str(start), end=str(end), text=text_content)
+        for fo, fields, join_fields, required, field_repr in span_features:
+            values = [entity.get(x) for x in fields]
+            if join_fields:
+                field = ".".join([v for v in values if v is not None])
             else:
-                parent_node = parent_node.getparent()
-        else:
-            current_node = et.SubElement(parent_node, "span", id=entity.get("{http://www.omg.org/XMI}id"), start=str(start), end=str(end), text=text_content)
-            for fo, fn in CONFIG["span_features"].items():
-                field, required = fn["field"], fn["required"]
-                if isinstance(field, list):
-                    field = ".".join([entity.get(x) for x in field if entity.get(x) is not None])  # in inception, it's more practical to split them, but not here
-                else:
-                    field = entity.get(field)
-                if not field and required:
-                    print(f"WARNING: Missing required fields {fn['field']} for entity {entity.get('{http://www.omg.org/XMI}id')}!")
-                    current_node.set(fo, "other")
-                elif field:
-                    current_node.set(fo, field.lower())
-        parent_node = current_node
-
-    relations = in_root.findall(f".//custom:{RELATION_LAYER}", namespaces={"custom":"http:///custom.ecore"})
+                field = values[0]
+            if not field and required:
+                report("missing-required-field", f"WARNING: Missing required fields {field_repr} for entity {entity_id}!", entity_id)
+                current_node.set(fo, "other")
+            elif field:
+                current_node.set(fo, field.lower())
+        stack.append((current_node, end))
+
+    relations = in_root.findall(f".//custom:{config['relation_layer']}", namespaces={"custom":"http:///custom.ecore"})
     relation_node = et.SubElement(work_root, "relations")
     for relation in relations:
         current_node = et.SubElement(
@@ -197,18 +368,18 @@ def create_work_tree(in_root, out_root, document_text, start_index_dict, end_ind
             "to":relation.get("Dependent"),
             }
             )
-        for fo, fn in CONFIG["relation_features"].items():
+        for fo, fn in config["relation_features"].items():
             field, required = fn["field"], fn["required"]
             if relation.get(field) is None:
                 if required:
-                    print(f"WARNING: Missing required field {field} for relation {relation.get('{http://www.omg.org/XMI}id')}!")
+                    report("missing-required-field", f"WARNING: Missing required field {field} for relation {relation.get('{http://www.omg.org/XMI}id')}!", relation.get("{http://www.omg.org/XMI}id"))
                     current_node.set(fo, relation.get("other"))
             else:
                 current_node.set(fo, relation.get(field).lower())
 
 
-def process_remaining_fields(fields, remaining_fields, debug_id):
-    other_info = CONFIG["schema_info"][fields]
+def process_remaining_fields(fields, remaining_fields, debug_id, config):
+    other_info = config["schema_info"][fields]
     out_dict = {}
     for feature, possible_values in other_info.items():
         for rf in remaining_fields:
@@ -219,16 +390,21 @@ def process_remaining_fields(fields, remaining_fields, debug_id):
         else:
             out_dict[feature] = possible_values[0]  # default value
     if remaining_fields and not (len(remaining_fields) == 1 and remaining_fields[0] == ""):
-        print(f"ERROR: Unrecognized information {remaining_fields} in span {debug_id}. Ignoring it.")
+        report("unrecognized-information", f"ERROR: Unrecognized information {remaining_fields} in span {debug_id}. Ignoring it.", debug_id)
     return out_dict
 
 
-def process_spans(out_root):
+def process_spans(out_root, token_texts, config, spans=None):
     """
     Process the spans and write them to the output XML tree.
     :param work_root: The root element of the work XML tree.
     :param out_root: The root element of the output XML tree.
+    :param token_texts: The token strings as returned by write_text.
+    :param config: The compiled config of the Processor.
+    :param spans: The SpanRegistry of out_root, built if not given.
     """
+    if spans is None:
+        spans = SpanRegistry(out_root)
 
     def do_parent_head_instructions(parent, child, instructions):
         parent_value = parent.get(feature).split(".")
@@ -242,15 +418,15 @@ def process_spans(out_root):
                 actions = parent_instruction["copy_by_index_to_head"]
                 for new_feature, copy_idx in actions.items():
                     # first check it isn't part of any of the other_fields values
-                    if copy_idx < len(parent_value) and parent_value[copy_idx] not in CONFIG["schema_info"]["other_fields_values"]:
+                    if copy_idx < len(parent_value) and parent_value[copy_idx] not in config["schema_info"]["other_fields_values"]:
                         new_value = parent_value[copy_idx]
                     else:
-                        new_value = CONFIG["head_defaults"].get(parent.get("class"))
+                        new_value = config["head_defaults"].get(parent.get("class"))
                     try:
                         child.set(new_feature, new_value)
                     except TypeError:
-                        print(f"WARNING: Could not assign head type for {child.get('id')}! Check if the head defaults are properly defined for class {parent.get('class')} and if the class of the parent {parent.get('id')} is correctly assigned.")
-                        child.set(new_feature, CONFIG["head_defaults"]["default"])
+                        report("head-type-unassigned", f"WARNING: Could not assign head type for {child.get('id')}! Check if the head defaults are properly defined for class {parent.get('class')} and if the class of the parent {parent.get('id')} is correctly assigned.", child.get("id"))
+                        child.set(new_feature, config["head_defaults"]["default"])
             if "add_feature_to_head" in parent_instruction:
                 actions = parent_instruction["add_feature_to_head"]
                 for new_feature, new_value in actions.items():
@@ -259,9 +435,9 @@ def process_spans(out_root):
             return
         
     def rename_attribute(field, instr):
-        if field in CONFIG["conversions"] and CONFIG["conversions"][field]:
-            if instr in CONFIG["conversions"][field]:
-                return CONFIG["conversions"][field][instr]  # TODO: extend to use regex
+        if field in config["conversions"] and config["conversions"][field]:
+            if instr in config["conversions"][field]:
+                return config["conversions"][field][instr]  # TODO: extend to use regex
         return instr
     
     def get_feature_by_coreference(span):
@@ -278,9 +454,9 @@ def process_spans(out_root):
                 # print a warning (TODO: put this in the settings as an option)
                 span.set("class", "unk")
                 span.set("numerus", "unk")
-                print(f"WARNING: No coreference relation found for pronoun class in span {span.get('id')}!")
+                report("pronoun-without-coreference", f"WARNING: No coreference relation found for pronoun class in span {span.get('id')}!", span.get("id"))
                 break
-            target = out_root.find(f"./spans//span[@id='{coref_relation.get('to')}']")
+            target = spans.get(coref_relation.get("to"))
             # is the target a pronoun too?
             if target.get("class") != "pro":
                 if target.get("element") == "list":
@@ -289,7 +465,7 @@ def process_spans(out_root):
                 elif target.get("element") == "appo":
                     # if the coref targets an apposition
                     # print a warning, but pass class and numerus of the parent
-                    print(f"WARNING: Coreference relation targetting apposition in span {span.get('id')}!")
+                    report("coreference-to-apposition", f"WARNING: Coreference relation targetting apposition in span {span.get('id')}!", span.get("id"))
                     span.set("class", target.getparent().get("class"))
                     span.set("numerus", target.getparent().get("numerus"))
                 else:
@@ -298,15 +474,14 @@ def process_spans(out_root):
                 break
             guard -= 1
 
-    for span in out_root.findall("./spans//span"):
-        for feature, instructions in CONFIG["span_features"].items():
+    for span in spans:
+        for feature, instructions in config["span_features"].items():
             instructions = instructions["process_instructions"]
             if not instructions:  # this signifies to ignore the feature
                 continue
             feature_value = span.get(feature).split(".")
-            for regex_key in instructions:
-                if re.match(regex_key, feature_value[0]):
-                    instruction = instructions[regex_key]
+            for pattern, instruction in config["compiled"]["span_instructions"][feature]:
+                if pattern.match(feature_value[0]):
                     new_span = span  # TODO: unify variables
                     # process the feature according to the instructions
                     for instr_name, instr_value in instruction.items():
@@ -336,11 +511,11 @@ def process_spans(out_root):
                                 if len(feature_value) > idx and feature_value[idx]:
                                     new_span.set(new_feature, feature_value[idx])
                         elif instr_name == "add_remaining_fields_by_schema_info":
-                            out_dict = process_remaining_fields("other_fields", feature_value[instr_value:], span.get("id"))
+                            out_dict = process_remaining_fields("other_fields", feature_value[instr_value:], span.get("id"), config)
                             for f, v in out_dict.items():
                                 new_span.set(f, v)
                         elif instr_name == "add_remaining_fields_by_event_info":
-                            out_dict = process_remaining_fields("event_fields", feature_value[instr_value:], span.get("id"))
+                            out_dict = process_remaining_fields("event_fields", feature_value[instr_value:], span.get("id"), config)
                             for f, v in out_dict.items():
                                 new_span.set(f, v)
                         elif instr_name == "add_all_other_fields_as":
@@ -353,7 +528,7 @@ def process_spans(out_root):
                             if parent.tag != "spans":
                                 do_parent_head_instructions(parent, new_span, instructions)
                             else:
-                                print(f"WARNING: Parent of span {span.get('id')} not found!")
+                                report("parent-not-found", f"WARNING: Parent of span {span.get('id')} not found!", span.get("id"))
                                 continue
                         elif instr_name == "requires_head" and instr_value:
                             # if no head is present, try to add one
@@ -371,7 +546,7 @@ def process_spans(out_root):
                                 # or if that would yield a span of 0, from last child to end. also print a warning when this happens.
                                 else:
                                     # print warning message
-                                    print(f"WARNING: No head found for span {span.get('id')}, other children present! Trying to supplement a head before first or after last child.")
+                                    report("head-supplemented", f"WARNING: No head found for span {span.get('id')}, other children present! Trying to supplement a head before first or after last child.", span.get("id"))
                                     # get the first child
                                     first_child = span[0]
                                     # get the start and end of the first child
@@ -384,7 +559,7 @@ def process_spans(out_root):
                                         start = str(int(span[-1].get("end"))+1)
                                         end = span.get("end")
                                     else:
-                                        print(f"ERROR: No head found for span {span.get('id')}, other children present! Failed to find space to supplement a head.")
+                                        report("missing-head", f"ERROR: No head found for span {span.get('id')}, other children present! Failed to find space to supplement a head.", span.get("id"))
                                         continue
                                 new_head_span = et.SubElement(new_span, "span", {
                                     "id": span.get("id") + "_head",
@@ -392,26 +567,26 @@ def process_spans(out_root):
                                     "end": end,
                                     "element": "head",
                                 })
+                                spans.add(new_head_span)
                                 do_parent_head_instructions(span, new_head_span, instructions)
-                                # getting the text is somewhat difficult
-                                new_head_span.set("text", " ".join([out_root.find(f"./text//token[@token_id='{x}']").text for x in range(int(start), int(end)+1)]))
+                                new_head_span.set("text", " ".join(token_texts[int(start):int(end)+1]))
                         elif instr_name == "process_eventelement":
                             pass  # depreciated, should be handled by the event processing instructions instead
                         elif instr_name == "print_warning_to_check":
-                            print(f"WARNING: span {span.get('id')} is marked as {feature_value[0]}! Please check the annotation.")
+                            report("marked-span", f"WARNING: span {span.get('id')} is marked as {feature_value[0]}! Please check the annotation.", span.get("id"))
                         else:
                             if instr_name in [
                                 "get_class_from_child_references",
                                 "if_no_class_get_class_from_head"
                             ]:
                                 continue
-                            print(f"WARNING: Unknown instruction {instr_name} for feature {feature} in span {span.get('id')}!")
+                            report("unknown-instruction", f"WARNING: Unknown instruction {instr_name} for feature {feature} in span {span.get('id')}!", span.get("id"))
                             continue
                     # set the text of the new span
                     new_span.set("text", span.get("text"))
                     break
             else:
-                print(f"WARNING: Unknown {feature} value {feature_value[0]} for span {span.get('id')}!")
+                report("unknown-feature-value", f"WARNING: Unknown {feature} value {feature_value[0]} for span {span.get('id')}!", span.get("id"))
                 continue
 
     def get_class_from_children(span):
@@ -427,15 +602,14 @@ def process_spans(out_root):
         return ";".join(sorted(all_classes))
 
     # NOTE: process certain functions after everything else has been processed, but before pronouns try to find their class
-    for span in out_root.findall("./spans//span"):
-        for feature, instructions in CONFIG["span_features"].items():
+    for span in spans:
+        for feature, instructions in config["span_features"].items():
             instructions = instructions["process_instructions"]
             if not instructions or span.get(feature) is None:
                 continue
             feature_value = span.get(feature).split(".")
-            for regex_key in instructions:
-                if re.match(regex_key, feature_value[0]):
-                    instruction = instructions[regex_key]
+            for pattern, instruction in config["compiled"]["span_instructions"][feature]:
+                if pattern.match(feature_value[0]):
                     for instr_name, instr_value in instruction.items():
                         if instr_name == "get_class_from_child_references":
                             new_class = get_class_from_children(span)
@@ -447,23 +621,22 @@ def process_spans(out_root):
                                 span.set("class", ";".join(sorted(classes)))
 
     # NOTE: worth considering if this should be in a separate function AFTER relations and events have been processed
-    for span in out_root.findall("./spans//span"):
+    for span in spans:
         if span.get("element") == "reference" and span.get("class") == "pro":
             # some info requires other info to already have been processed, so we add those instructions in a second loop
             get_feature_by_coreference(span)
 
 
-def process_relations(out_root):
+def process_relations(out_root, config):
     relations = out_root.findall("./relations/relation")
     for relation in relations:
-        for feature, instructions in CONFIG["relation_features"].items():
+        for feature, instructions in config["relation_features"].items():
             instructions = instructions["process_instructions"]
             if not instructions:  # no special operations
                 continue
             feature_value = relation.get(feature).split(".")
-            for regex_key in instructions:
-                if re.match(regex_key, feature_value[0]):
-                    instruction = instructions[regex_key]
+            for pattern, instruction in config["compiled"]["relation_instructions"][feature]:
+                if pattern.match(feature_value[0]):
                     for instr_name, instr_value in instruction.items():
                         if instr_name == "new_features":
                             for new_feature, new_value in instr_value.items():
@@ -472,7 +645,7 @@ def process_relations(out_root):
                             for idx, new_feature in instr_value.items():
                                 relation.set(new_feature, feature_value[idx])
                         elif instr_name == "add_remaining_fields_by_event_info":
-                            out_dict = process_remaining_fields("event_fields", feature_value[instr_value:], relation.get("id"))
+                            out_dict = process_remaining_fields("event_fields", feature_value[instr_value:], relation.get("id"), config)
                             for f, v in out_dict.items():
                                 relation.set(f, v)
                         elif instr_name == "add_all_other_fields_as":
@@ -481,7 +654,39 @@ def process_relations(out_root):
                     break
 
 
-def write_events(out_root):
+def group_participants_by_subevent(participants):
+    """
+    Group event participants into subevents by their role ids.
+    The role ids are inserted into a prefix trie. Every id that is not the prefix
+    of another id spawns its own subevent, which receives all participants whose
+    id lies on the path to it (a participant without id takes part in all subevents).
+    Subevents are returned sorted by their id, participants keep their original order.
+    :param participants: list of (role_elem, roleinfo) tuples.
+    :return: list of (subevent_id, participants) tuples.
+    """
+    root = ({}, [])  # a trie node is a tuple of (children, indices of participants ending here)
+    for idx, (_, roleinfo) in enumerate(participants):
+        node = root
+        for char in ".".join(roleinfo["id"]):
+            node = node[0].setdefault(char, ({}, []))
+        node[1].append(idx)
+
+    subevents = []
+    stack = [(root, "", [])]
+    while stack:
+        (children, indices), subevent_id, inherited = stack.pop()
+        inherited = inherited + indices
+        if not children:
+            if inherited:
+                subevents.append((subevent_id, [participants[i] for i in sorted(inherited)]))
+            continue
+        # push in reverse so the subevents are popped in sorted order
+        for char in sorted(children, reverse=True):
+            stack.append((children[char], subevent_id + char, inherited))
+    return subevents
+
+
+def write_events(out_root, config, spans=None):
     """
     We write events and situations here.
     - the trigger is not the important part, but instead the event-span
@@ -519,8 +724,8 @@ def write_events(out_root):
         return roles
     
     def apply_role_name_conversions(entity_type):
-        for o, r in CONFIG["conversions"]["role_names"].items():
-            entity_type = re.sub(o, r, entity_type)
+        for pattern, r in config["compiled"]["role_name_conversions"]:
+            entity_type = pattern.sub(r, entity_type)
         return entity_type
     
     def create_event(event, event_node, event_triggers, participants, running_ids):
@@ -528,57 +733,40 @@ def write_events(out_root):
         for event_trigger in event_triggers:
             trigger_node = et.SubElement(event_node, "trigger", start=event_trigger.get("start"), end=event_trigger.get("end"), text=event_trigger.get("text"), ref=event_trigger.get("id"))
         # write list of Subevents
-        # first identify distinct subevent ids
-        subevent_ids = set([".".join(roleinfo["id"]) for _, roleinfo in participants])
-        dictinct_ids = []
-        for si in subevent_ids:
-            for si2 in subevent_ids:
-                if si == si2:
-                    continue
-                if si2.startswith(si):
-                    break
-            else:
-                dictinct_ids.append(si)
         # each distinct id spawns its own subevent
-        for num, di in enumerate(sorted(dictinct_ids)):
+        subevents = group_participants_by_subevent(participants)
+        for num, (_, subevent_participants) in enumerate(subevents):
             subevent_node = et.SubElement(event_node, "event", event_id=event_node.get("event_id")+"."+str(num))
-            for role_elem, roleinfo in participants:
-                roleid = ".".join(roleinfo["id"])
-                if di.startswith(roleid):
-                    if role_elem.tag == "spans":
-                        print(f"ERROR: Describing Element (e.g. Apposition, Attribute) without List or Reference to nest it! See {event.get('id')}")
-                        continue
-                    # TODO: Implement handling of appositions inside lists (project role to all members of the list instead)
-                    #print(str(role_elem.tag), str(role_elem.attrib).encode("utf8"))
-                    ref_class = role_elem.get("class") if role_elem.get("class") is not None else role_elem.find("span[@element='head']").get("class")
-                    role_node = et.SubElement(subevent_node, "role", role=apply_role_name_conversions(roleinfo["role"].strip()), ref=role_elem.get("id"), ref_class=ref_class)
-                    role_node.set("text", role_elem.get("text"))
-                    if role_elem in elems_with_roles:
-                        # check first if it's in there,
-                        # because one role elem can be in multiple subevents
-                        elems_with_roles.remove(role_elem)
+            for role_elem, roleinfo in subevent_participants:
+                if role_elem.tag == "spans":
+                    report("unnested-describing-element", f"ERROR: Describing Element (e.g. Apposition, Attribute) without List or Reference to nest it! See {event.get('id')}", event.get("id"))
+                    continue
+                # TODO: Implement handling of appositions inside lists (project role to all members of the list instead)
+                #print(str(role_elem.tag), str(role_elem.attrib).encode("utf8"))
+                ref_class = role_elem.get("class") if role_elem.get("class") is not None else role_elem.find("span[@element='head']").get("class")
+                role_node = et.SubElement(subevent_node, "role", role=apply_role_name_conversions(roleinfo["role"].strip()), ref=role_elem.get("id"), ref_class=ref_class)
+                role_node.set("text", role_elem.get("text"))
+                # one role elem can be in multiple subevents, the set takes care of duplicates
+                matched_role_elems.add(role_elem)
 
             # change role names according to config
             if subevent_node.find("role[@role='source']") is not None:
-                for term, info in CONFIG["implicit_event_processing"].items():
+                for term, patterns, info, role_templates in config["compiled"]["implicit_events"]:
                     if type(term) == str:
-                        m = re.match(term, event_node.get("class"))
+                        m = patterns[0].match(event_node.get("class"))
                         if m:
                             break
                     elif type(term) == tuple:
-                        m = re.match(term[0], event_node.get("class"))
+                        m = patterns[0].match(event_node.get("class"))
                         if m:
-                            m = re.match(term[1], subevent_node.find("role[@role='source']").get("ref_class"))
+                            m = patterns[1].match(subevent_node.find("role[@role='source']").get("ref_class"))
                             if m:
                                 #print(et.tostring(subevent_node.getparent()))
-                                m = re.match(term[2], subevent_node.find("role[@role='target']").get("ref_class"))
+                                m = patterns[2].match(subevent_node.find("role[@role='target']").get("ref_class"))
                                 if m:
                                     break
-                    else:
-                        print(f"ERROR: Unknown term type {type(term)} in implicit event processing!")
-                        exit()
                 else:
-                    print("WARNING: No event definition found for event {0} (while processing Element {1})!".format(subevent_node.get("event_id"), event.get("id")))
+                    report("unknown-event-definition", "WARNING: No event definition found for event {0} (while processing Element {1})!".format(subevent_node.get("event_id"), event.get("id")), event.get("id"))
                     info = None
                 if info is not None:
                     if "no_event" in info and info["no_event"]:
@@ -586,7 +774,7 @@ def write_events(out_root):
                         break
                     # rename event, source and target
                     # only rename the event if it's the last subevent! (or the ones before won't match)
-                    if "rename" in info and num == len(dictinct_ids) - 1:
+                    if "rename" in info and num == len(subevents) - 1:
                         event_node.set("class", info["rename"])
                     for role in subevent_node.findall("./role"):
                         old_role = role.get("role")
@@ -595,12 +783,12 @@ def write_events(out_root):
                             continue
                         for r in info["roles"]:
                             if old_role == r:
-                                for template, new_role in info["roles"][r].items():
-                                    if re.match(template, role.get("ref_class")):
+                                for template, new_role in role_templates[r]:
+                                    if template.match(role.get("ref_class")):
                                         role.set("role", new_role)
                                         break
                                 else:
-                                    print(f"WARNING: No role definition found for role {role.get('role')} in event {subevent_node.get('event_id')} (while processing Element {event.get('id')})!")
+                                    report("unknown-role-definition", f"WARNING: No role definition found for role {role.get('role')} in event {subevent_node.get('event_id')} (while processing Element {event.get('id')})!", event.get("id"))
                         if old_role == "source" and len(subevent_node.findall(f"./role[@role='{new_role}']")) > 1:
                             # special case: ignore the source when there is already another role which has the new_role role
                             # print(f"TESTING: Removing a source role because another has been found in event {subevent_node.get('event_id')}")
@@ -609,17 +797,52 @@ def write_events(out_root):
         return running_ids
     
     # update span lengths after other events have been added
-    def update_eventspan_length(event, events_node, already_processed):
-        already_processed.append(event)
-        for subevent in event.findall("./event"):
-            for role in subevent.findall("./role"):
-                ref = role.get("ref")
-                corr = events_node.find("./eventGroup[@event_id='" + ref + "']")
-                if corr is not None:
-                    if corr not in already_processed:
-                        update_eventspan_length(corr, events_node, already_processed)
-                    event.set("start", str(min([int(event.get("start")), int(corr.get("start"))])))
-                    event.set("end", str(max([int(event.get("end")), int(corr.get("end"))])))
+    def update_eventspan_lengths(events_node):
+        """
+        Events can take part in other events (a role refers to the id of another eventGroup).
+        These references are collected into a dependency graph and every event span is
+        stretched over the spans of the events it depends on. The graph is processed in
+        topological order, so each dependency is final before it is used.
+        """
+        event_groups = events_node.findall("./eventGroup")
+        group_indices = {}
+        for idx, event in enumerate(event_groups):
+            group_indices.setdefault(event.get("event_id"), idx)
+        extents = [
+            [int(event.get("start")), int(event.get("end"))] if event.get("start") is not None and event.get("end") is not None else None
+            for event in event_groups
+        ]
+
+        dependents = [[] for _ in event_groups]
+        in_degree = [0] * len(event_groups)
+        for idx, event in enumerate(event_groups):
+            for role in event.iterfind("./event/role"):
+                corr_idx = group_indices.get(role.get("ref"))
+                if corr_idx is None or corr_idx == idx:  # referring to itself never changes the span
+                    continue
+                dependents[corr_idx].append(idx)
+                in_degree[idx] += 1
+
+        queue = deque(idx for idx, degree in enumerate(in_degree) if degree == 0)
+        while queue:
+            idx = queue.popleft()
+            for dependent_idx in dependents[idx]:
+                if extents[idx] is not None and extents[dependent_idx] is not None:
+                    extents[dependent_idx][0] = min(extents[dependent_idx][0], extents[idx][0])
+                    extents[dependent_idx][1] = max(extents[dependent_idx][1], extents[idx][1])
+                in_degree[dependent_idx] -= 1
+                if in_degree[dependent_idx] == 0:
+                    queue.append(dependent_idx)
+
+        # events still waiting for a dependency are part of a cycle (or depend on one)
+        cyclic = [event_groups[idx].get("event_id") for idx, degree in enumerate(in_degree) if degree > 0]
+        if cyclic:
+            report("event-cycle", f"ERROR: During event postprocessing, the events with ids {cyclic} were found to reference each other in a cycle. Their span lengths could not be updated.")
+
+        for event, extent in zip(event_groups, extents):
+            if extent is not None:
+                event.set("start", str(extent[0]))
+                event.set("end", str(extent[1]))
 
     def solve_list(list_elem, collector, prev_roles, transfer_roles=False):
         """
@@ -649,25 +872,33 @@ def write_events(out_root):
         matching_relations = out_root.xpath("./relations/relation[@from='{0}' and starts-with(@label, '{1}')]".format(event.get("id"), prefix + "."))
         for relation in matching_relations:
             # get the target element
-            target = out_root.find(f"./spans//span[@id='{relation.get('to')}']")
+            target = spans.get(relation.get("to"))
             role = relation.get("label").split(".")[1]
             yield (target, {"id": event_id, "role": role})
 
+    if spans is None:
+        spans = SpanRegistry(out_root)
+    # the element attributes are final after process_spans
+    spans_by_element = spans.by_element()
+
     # move all roles from list elements to their children
-    for list_elem in out_root.xpath("./spans//span[@element='list' and not(parent::span[@element='list'])]"):
-        solve_list(list_elem, [], [], transfer_roles=True)
+    for list_elem in spans_by_element.get("list", []):
+        if list_elem.getparent().get("element") != "list":
+            solve_list(list_elem, [], [], transfer_roles=True)
 
     # collect all elements with roles so we can later detect which ones didnt get an event
-    elems_with_roles = out_root.xpath("./spans//span[string-length(@role) > 0]")
+    # (the list keeps the document order for the report, the set records which ones were matched)
+    elems_with_roles = [span for span in spans if span.get("role")]
+    matched_role_elems = set()
 
     events_node = et.SubElement(out_root, "eventGroups")
     
-    previously_used_triggers = []
+    previously_used_triggers = set()
 
     # eventspan handling
     # TODO: Make this configurable via the config file
     running_ids = 0
-    eventspans = out_root.xpath("./spans//span[@element='interaction']")
+    eventspans = spans_by_element.get("interaction", [])
     for event in eventspans:
         event_id = next(role for role in get_roles(event.get("role"), is_evt=True) if role["role"] == "evt")["id"]  # TODO: as we're not using the role field anymore we can simplify this
         # find a trigger if present
@@ -680,7 +911,7 @@ def write_events(out_root):
                 event_triggers.append(trigger)
                 # add event type to trigger from eventspan
                 trigger.set("class", event.get("class"))
-                previously_used_triggers.append(trigger)
+                previously_used_triggers.add(trigger)
         # collect participants
         candidates = []
         for child in event:
@@ -720,7 +951,7 @@ def write_events(out_root):
     # events based on references
     # self is always participant in the event
     # don't write events if only one entity (self) is present
-    reference_spans = out_root.xpath("./spans//span[@element='reference']")
+    reference_spans = spans_by_element.get("reference", [])
     for event in reference_spans:
         event_id = [""]  # more complex events need to be presented as eventspans in the current system
         head = event.find("./span[@element='head']")
@@ -779,7 +1010,7 @@ def write_events(out_root):
 
     
     # events based on appositions
-    appo_spans = out_root.xpath("./spans//span[@element='appo']")
+    appo_spans = spans_by_element.get("appo", [])
     for event in appo_spans:
         event_id = [""]  # more complex events need to be presented as eventspans in the current system
         head = event.find("./span[@element='head']")
@@ -848,7 +1079,7 @@ def write_events(out_root):
 
     # events based on attributes
     # NOTE: parent references of attributes can be explicitly annotated with a role by putting that role info as part of the attribute (e.g. label="attr.sale" role="property")
-    attr_spans = out_root.xpath("./spans//span[@element='attr']")
+    attr_spans = spans_by_element.get("attr", [])
     for event in attr_spans:
         event_id = [""]  # more complex events need to be presented as eventspans in the current system
         triggers = event.findall("./span[@element='trigger']")
@@ -859,12 +1090,12 @@ def write_events(out_root):
             if trigger_id == [""]:
                 event_triggers.append(trigger)
                 trigger.set("class", event.get("class"))
-                previously_used_triggers.append(trigger)
+                previously_used_triggers.add(trigger)
         if triggers != event_triggers:
             # if some triggers were not added, it means they had an event id, and we better let the triggers handle the 
             # event instead of the attribute
             if len(event_triggers) > 0:
-                print("ERROR: Multiple triggers, some without ids, were found in a single Attribute span. See ID {0}.".format(event.get("id")))
+                report("multiple-triggers", "ERROR: Multiple triggers, some without ids, were found in a single Attribute span. See ID {0}.".format(event.get("id")), event.get("id"))
             continue
         parent = event.xpath("ancestor::span[@element='reference' or @element='list'][1]")[0]
         if parent.get("element") == "reference":
@@ -924,7 +1155,7 @@ def write_events(out_root):
             running_ids = create_event(event, event_node, event_triggers, participants, running_ids)
 
     # event based on trigger handling
-    trigger_spans = out_root.xpath("./spans//span[@element='trigger']")
+    trigger_spans = spans_by_element.get("trigger", [])
     for trigger in trigger_spans:
         # make sure that you don't belong to an event span
         if trigger in previously_used_triggers:
@@ -974,7 +1205,7 @@ def write_events(out_root):
             continue
 
         # If one of the arrows points to a list, add each child as participant instead of the list
-        source = out_root.find(f"./spans//span[@id='{relation.get('from')}']")
+        source = spans.get(relation.get("from"))
         sources = []
         if source.get("element") == "list":
             collector = []
@@ -983,7 +1214,7 @@ def write_events(out_root):
         else:
             sources.append(source)
         
-        target = out_root.find(f"./spans//span[@id='{relation.get('to')}']")
+        target = spans.get(relation.get("to"))
         targets = []
         if target.get("element") == "list":
             collector = []
@@ -1015,22 +1246,19 @@ def write_events(out_root):
                 running_ids = create_event(relation, event_node, [], participants, running_ids)
 
     # fit all event span start and ends
-    already_processed = []
-    for event in events_node:
-        try:
-            update_eventspan_length(event, events_node, already_processed)
-        except RecursionError:
-            print(f"ERROR: During event postprocessing, a recursion error occured while the event with id {event.get('event_id')} was processed. This should not be happening and is indicating an error in the code.")
+    update_eventspan_lengths(events_node)
 
     # check if all roles were assigned to events. Throw error if they weren't assigned
     for role_elem in elems_with_roles:
+        if role_elem in matched_role_elems:
+            continue
         if role_elem.get("element") == "list":
             continue
         if "trigger" in role_elem.get("role"):
             continue
         if role_elem.get('role').isnumeric():  # evt id
             continue
-        print(f"ERROR: The span {role_elem.get('id')} with a role annotation {role_elem.get('role')} couldn't be matched to an event.")
+        report("unmatched-role", f"ERROR: The span {role_elem.get('id')} with a role annotation {role_elem.get('role')} couldn't be matched to an event.", role_elem.get("id"))
 
 
 def write_coref(out_root):
@@ -1060,13 +1288,15 @@ def apply_special_operations_before_processing(out_root):
     return
 
 
-def apply_special_operations_between_processing(out_root):
+def apply_special_operations_between_processing(out_root, spans=None):
     # NOTE: Probably should move all this to a regular step instead of making a special function
     merge = {
         # put here any classes you want to rename (key=old, value=new)
         # you can also do this in renaming.py so it may be a bit redundant
     }
-    for span in out_root.findall("./spans//span"):
+    if spans is None:
+        spans = SpanRegistry(out_root)
+    for span in spans:
         span_class = span.get("class")
         if span_class is None:
             continue
@@ -1084,11 +1314,29 @@ def apply_special_operations_between_processing(out_root):
             span.set("subclass", "")
 
 
-def apply_special_operations_after_processing(out_root):
+def lookup_alias(name, aliases, substring_aliases):
+    """
+    Look up an event or role name in the alias tables of build_lookup_tables.
+    Alternative names given as a single string match every name they contain (e.g. "unclear" also matches "unc"),
+    these are only scanned if there is no exact match.
+    :return: The entry of the first config matching name, None if none does.
+    """
+    entry = aliases.get(name)
+    if entry is None:
+        entry = next((e for alternative_names, e in substring_aliases if name in alternative_names), None)
+    return entry
+
+
+def apply_special_operations_after_processing(out_root, config, spans=None):
     """
     event postprocessing goes here as well currently.
     """
-    def do_special_operations(event_group, event_config):
+    if spans is None:
+        spans = SpanRegistry(out_root)
+    compiled = config["compiled"]
+
+    def do_special_operations(event_group, event_idx):
+        event_config = config["event_postprocessing"][event_idx]
         for special_operation in event_config.get("special_operations", []):
             # perform special actions
             if special_operation == "check_if_payment_or_obligation":
@@ -1098,39 +1346,35 @@ def apply_special_operations_after_processing(out_root):
                     continue
                 date = event.find("role[@role='date']")
                 if date is None:
-                    due_oblig_config = next((d for d in CONFIG["event_postprocessing"] if d.get('name') == 'due-obligation'), None)
                     event_group.set("class", "due-obligation")
-                    event_config = due_oblig_config
-                    do_special_operations(event_group, event_config)
+                    event_idx = compiled["due_obligation"]
+                    do_special_operations(event_group, event_idx)
             elif special_operation == "include_due_roles":
-                # add all roles from due_obligations to the event config
-                due_oblig_config = next((d for d in CONFIG["event_postprocessing"] if d.get('name') == 'due-obligation'), None)
-                event_config["main_classes"] += due_oblig_config["main_classes"]
-                if "other_classes" in event_config:
-                    event_config["other_classes"] += due_oblig_config["other_classes"]
-                else:
-                    event_config["other_classes"] = due_oblig_config["other_classes"]
+                # the roles from due_obligations are added to the role tables of this event when the config is compiled
+                pass
             else:
-                print(f"EVENT POSTPROCESSING ERROR: No matching instruction found for special operation '{special_operation}' while processing event {event_class}")
+                report("unknown-special-operation", f"EVENT POSTPROCESSING ERROR: No matching instruction found for special operation '{special_operation}' while processing event {event_class}", event_group.get("ref"))
 
-        return event_config  # return it in case it changed
+        return event_idx  # return it in case it changed
 
 
     # iterate all event groups and look them up in our event list
     event_groups = out_root.find("eventGroups").findall("eventGroup")
     for event_group in event_groups:
         event_class = event_group.get("class").replace("_", "-")
-        for event_config in CONFIG["event_postprocessing"]:
-            if event_config["name"] == event_class:
-                break
-            if event_class in event_config.get("alternative_names", []):
-                # rename the event group if it has an alternative name
-                event_group.set("class", event_config["name"])
-                break
+        alias = lookup_alias(event_class, compiled["event_aliases"], compiled["event_substring_aliases"])
+        if alias is None:
+            report("unknown-event-config", f"EVENT POSTPROCESSING WARNING: No event config could be found for event {event_class}!", event_group.get("ref"))
+            event_idx = len(config["event_postprocessing"]) - 1  # the last event config is used as a fallback
         else:
-            print(f"EVENT POSTPROCESSING WARNING: No event config could be found for event {event_class}!")
+            event_idx, is_alternative_name = alias
+            if is_alternative_name:
+                # rename the event group if it has an alternative name
+                event_group.set("class", config["event_postprocessing"][event_idx]["name"])
 
-        event_config = do_special_operations(event_group, event_config)
+        event_idx = do_special_operations(event_group, event_idx)
+        event_config = config["event_postprocessing"][event_idx]
+        role_tables = compiled["event_roles"][event_idx]
 
         # add type if it is an event or a state
         event_group.set("type", event_config["type"])
@@ -1146,40 +1390,32 @@ def apply_special_operations_after_processing(out_root):
                 if role_class == "detail":
                     role.set("role", "detail_other")
                     continue
-                for role_config in event_config["main_classes"] + CONFIG["event_generic_roles"]:
-                    if role_config["name"] == role_class:
-                        role.set("role", role_class)
-                        break
-                    if role_class in role_config.get("alternative_names", []):
-                        # a) if they have an alternative name, give it the proper name
-                        role.set("role", role_config["name"])
-                        break
+                role_config = lookup_alias(role_class, role_tables["main"], role_tables["main_substring"])
+                if role_config is not None:
+                    # a) if they have an alternative name, give it the proper name
+                    role.set("role", role_config[0])
                 else:
                     role_class = role_class.replace("detail-", "")
                     role_class = role_class.replace("detail_", "")
-                    for role_config in event_config.get("other_classes", []):
-                        if role_config["name"] == role_class:
-                            role.set("role", "detail_" + role_config["name"])
-                            break
-                        if role_class in role_config.get("alternative_names", []):
-                            # a) if they have an alternative name, give it the proper name
-                            role.set("role", "detail_" + role_config["name"])
-                            break
+                    role_config = lookup_alias(role_class, role_tables["other"], role_tables["other_substring"])
+                    if role_config is not None:
+                        # a) if they have an alternative name, give it the proper name
+                        role.set("role", "detail_" + role_config[0])
                     else:
-                        print(f"EVENT POSTPROCESSING WARNING: No role config could be found for role {role_class} in event {event_class}!")
+                        report("unknown-role-config", f"EVENT POSTPROCESSING WARNING: No role config could be found for role {role_class} in event {event_class}!", role.get("ref"))
+                        role_config = role_tables["fallback"]
+                        if role_config is None:
+                            continue
+                role_name, allowed_classes = role_config
                 # b) check if the entity class is allowed for that role
-                cfg_classes = role_config.get("classes", [])
-                allowed_classes = []
-                for cls in cfg_classes:
-                    if cls in CONFIG["event_processing_entity_class_groupings"]:
-                        allowed_classes.extend(CONFIG["event_processing_entity_class_groupings"][cls])
-                    else:
-                        allowed_classes.append(cls)
                 if not allowed_classes:
                     continue  # if no allowed classes are specified all are allowed
                 role_entity_class = role.get("ref_class")
                 ref = role.get("ref")
-                ref_elem = out_root.find("spans").find(f".//span[@id='{ref}']").get("element")
+                ref_span = spans.get(ref)
+                if ref_span is None:
+                    continue  # reported by check_references
+                ref_elem = ref_span.get("element")
                 if role_entity_class in ["unc", "unk", "other"]:  # other should be restricted to only actual "other" entities, not for modifiers as well
                     pass
                 elif role_entity_class in allowed_classes:
@@ -1191,101 +1427,746 @@ def apply_special_operations_after_processing(out_root):
                 elif "#event" in allowed_classes and ref_elem in ["trigger", "eventspan"]:
                     pass  # all good
                 else:
-                    print("EVENT POSTPROCESSING WARNING: role entity class '{}' is not allowed by config for role '{}' in event '{}'.".format(role_entity_class, role_config["name"], event_config["name"]))
+                    report("role-class-not-allowed", "EVENT POSTPROCESSING WARNING: role entity class '{}' is not allowed by config for role '{}' in event '{}'.".format(role_entity_class, role_name, event_config["name"]), role.get("ref"))
 
                     
-def cleanup(out_root):
+def get_span_ids(out_root, spans=None):
+    if spans is not None:
+        return spans.ids.keys()
+    return {span.get("id") for span in out_root.find("spans").iter("span")}
+
+
+def check_relations(out_root, spans=None):
     """
-    Remove unwanted elements, attributes, etc.
+    Remove the relations pointing (from/to) to a missing span before they are processed,
+    e.g. when a span was deleted but its relation was not. The later steps only see valid relations.
+    :param spans: The SpanRegistry of out_root, the span ids are collected from the tree if not given.
+    """
+    span_ids = get_span_ids(out_root, spans)
+    relations_node = out_root.find("relations")
+    for relation in relations_node.findall("relation"):
+        missing = [f"{attr} '{relation.get(attr)}'" for attr in ["from", "to"] if relation.get(attr) not in span_ids]
+        if missing:
+            report("dangling-relation", f"ERROR: Relation {relation.get('id')} points to a missing span ({' and '.join(missing)}) and is ignored.", relation.get("id"))
+            relations_node.remove(relation)
+
+
+def check_references(out_root, spans=None):
     """
-    # check all ref-Attributes and make sure elements with those ids exist
-    spans = out_root.find("spans")
+    Check all ref-Attributes and make sure elements with those ids exist.
+    Relations and other elements pointing (from/to) to a missing span are removed.
+    :param spans: The SpanRegistry of out_root, the span ids are collected from the tree if not given.
+    """
+    span_ids = get_span_ids(out_root, spans)
+
+    dangling = []
     for elem in out_root.xpath("./relations//* | ./eventGroups//*"):
-        for attr in ["ref", "from", "to"]:
-            if elem.get(attr) is not None and elem.get(attr):
-                ref_id = elem.get(attr)
-                ref_span = spans.find(f".//span[@id='{ref_id}']")
-                if ref_span is None:
-                    if attr in ["from", "to"]:
-                        # this was a manual change where an element was deleted and we forgot to remove the coref as well
-                        if elem.getparent() is not None:
-                            elem.getparent().remove(elem)
-                    else:
-                        print(f"WARNING: Element with id '{ref_id}' referenced in {elem.tag} does not exist in the spans section.")
-                        print(et.tostring(elem))
-    
+        ref_id = elem.get("ref")
+        if ref_id and ref_id not in span_ids:
+            report("dangling-reference", f"WARNING: Element with id '{ref_id}' referenced in {elem.tag} does not exist in the spans section.", ref_id)
+        for attr in ["from", "to"]:
+            ref_id = elem.get(attr)
+            if ref_id and ref_id not in span_ids:
+                # this was a manual change where an element was deleted and we forgot to remove the coref as well
+                report("dangling-relation", f"ERROR: {elem.tag} {elem.get('id')} points to a missing span ({attr} '{ref_id}') and is removed.", elem.get("id"))
+                dangling.append(elem)
+                break
+
+    for elem in dangling:
+        if elem.getparent() is not None:
+            elem.getparent().remove(elem)
+
+
+def cleanup(out_root, config, write_span_text=True, spans=None):
+    """
+    Remove unwanted elements, attributes, etc.
+    """
+    if spans is None:
+        spans = SpanRegistry(out_root)
+    check_references(out_root, spans)
+
     # remove span attributes
-    for span in spans.findall(".//span"):
-        for attr in CONFIG["span_attributes_to_remove"]:
+    for span in spans:
+        for attr in config["span_attributes_to_remove"]:
             span.attrib.pop(attr, None)
     
     # remove relation attributes
     for relation in out_root.find("relations").findall("relation"):
-        for attr in CONFIG["relation_attributes_to_remove"]:
+        for attr in config["relation_attributes_to_remove"]:
             relation.attrib.pop(attr, None)
 
     # remove the ref_class helper attribute
     for role in out_root.xpath("./eventGroups/eventGroup/event/role"):
         role.attrib.pop("ref_class", None)
 
+    # the text attributes duplicate the document text and can be dropped to save space
+    if not write_span_text:
+        for span in spans:
+            span.attrib.pop("text", None)
+        for elem in out_root.xpath("./eventGroups/eventGroup/trigger | ./eventGroups/eventGroup/event/role"):
+            elem.attrib.pop("text", None)
+
         
-def process(in_root, outname):
+class FrozenDict(dict):
+    """
+    A read-only dict for the compiled config. Unlike types.MappingProxyType,
+    it can be pickled, so the compiled config can be cached on disk.
+    """
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("The compiled config is read-only.")
+
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = setdefault = update = _readonly
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+
+def freeze(obj):
+    """
+    Return a read-only copy of obj: dicts become FrozenDicts and lists become tuples.
+    """
+    if isinstance(obj, FrozenDict):
+        return obj
+    if isinstance(obj, dict):
+        return FrozenDict({k: freeze(v) for k, v in obj.items()})
+    if isinstance(obj, (list, tuple)):
+        return tuple(freeze(v) for v in obj)
+    return obj
+
+
+def build_lookup_tables(config):
     """
-    Process the XMI file and write the output to a new file.
-    :param in_root: The root element of the input XML tree.
-    :param outname: The name of the output file.
+    Compile the parts of the config that are looked up for every span, relation, event and role:
+    - span_fields: how to extract the span features from an XMI annotation
+    - span_instructions/relation_instructions: per feature a tuple of (compiled regex, instruction)
+    - role_name_conversions: tuple of (compiled regex, replacement)
+    - implicit_events: tuple of (term, compiled regexes, info, role templates as compiled regexes)
+    - event_aliases: event name or alternative name -> (index in event_postprocessing, is alternative name)
+    - event_substring_aliases: (alternative names, entry) of the alternative names given as a single string,
+      which match every name they contain (see lookup_alias)
+    - event_roles: per event config, role name or alternative name -> (name, allowed entity classes)
+      for the main and the other (detail) roles with their substring aliases, plus the role used when none matches.
+      The roles of include_due_roles are already added here.
+    The exact tables hold the first config in config order that matches a name, as the configs were scanned before.
+    - work_tree_hash: hash of everything the work tree depends on besides the XMI, i.e. the
+      layer_processing settings read by create_work_tree and the code of this file
     """
-    # for debugging
-    #print(et.tostring(in_root, encoding='unicode', pretty_print=True))
+    def compile_instructions(features):
+        return {
+            feature: tuple((re.compile(regex_key), instruction) for regex_key, instruction in spec["process_instructions"].items())
+            for feature, spec in features.items()
+        }
+
+    # in inception, it's more practical to split fields, but not here, so lists of fields are joined by "."
+    span_fields = []
+    for fo, fn in config["span_features"].items():
+        field = fn["field"]
+        join_fields = isinstance(field, (list, tuple))
+        span_fields.append((fo, tuple(field) if join_fields else (field,), join_fields, fn["required"], list(field) if join_fields else field))
+
+    implicit_events = []
+    for term, info in config["implicit_event_processing"].items():
+        if type(term) == str:
+            patterns = (re.compile(term),)
+        elif type(term) == tuple:
+            patterns = tuple(re.compile(t) for t in term)
+        else:
+            print(f"ERROR: Unknown term type {type(term)} in implicit event processing!")
+            exit()
+        role_templates = {r: tuple((re.compile(t), new_role) for t, new_role in templates.items()) for r, templates in info.get("roles", {}).items()}
+        implicit_events.append((term, patterns, info, role_templates))
+
+    def get_role_entry(role_config):
+        allowed_classes = set()
+        for cls in role_config.get("classes", []):
+            if cls in config["event_processing_entity_class_groupings"]:
+                allowed_classes.update(config["event_processing_entity_class_groupings"][cls])
+            else:
+                allowed_classes.add(cls)
+        return (role_config["name"], frozenset(allowed_classes))
 
-    text_node = in_root.find("./cas:Sofa", namespaces={"cas":"http:///uima/cas.ecore"})
-    document_text = text_node.get("sofaString")
+    def get_alternative_names(cfg):
+        # alternative names can either be a single string or a list of strings
+        alternative_names = cfg.get("alternative_names", [])
+        return (alternative_names,) if isinstance(alternative_names, str) else alternative_names
 
-    out_root = et.Element("doc", nsmap={None: "https://dhbern.github.io/BeNASch/ns"})
-    out_text = et.SubElement(out_root, "text")
-    start_index_dict, end_index_dict = write_text(out_text, document_text, in_root)
+    def get_alias_tables(configs, get_entry):
+        """
+        :return: ({name or alternative name: entry of the first matching config}, substring aliases), see lookup_alias
+        """
+        def matches(cfg, name):
+            # a single string as alternative names matches every name it contains
+            return cfg["name"] == name or name in cfg.get("alternative_names", [])
+
+        aliases = {}
+        for cfg in configs:
+            for name in (cfg["name"], *get_alternative_names(cfg)):
+                if name not in aliases:
+                    # an earlier config can match the name as well, through a substring of its alternative names
+                    idx = next(i for i, c in enumerate(configs) if matches(c, name))
+                    aliases[name] = get_entry(idx, name)
+        substring_aliases = tuple(
+            (cfg["alternative_names"], get_entry(idx, None))
+            for idx, cfg in enumerate(configs) if isinstance(cfg.get("alternative_names"), str)
+        )
+        return aliases, substring_aliases
+
+    def get_alias_map(role_configs):
+        return get_alias_tables(role_configs, lambda idx, name: get_role_entry(role_configs[idx]))
+
+    events = config["event_postprocessing"]
+    event_aliases, event_substring_aliases = get_alias_tables(events, lambda idx, name: (idx, events[idx]["name"] != name))
+    due_obligation = next((idx for idx, d in enumerate(events) if d.get("name") == "due-obligation"), None)
+
+    event_roles = []
+    for event_config in events:
+        main_classes = tuple(event_config.get("main_classes", ()))
+        other_classes = tuple(event_config.get("other_classes", ()))
+        if "include_due_roles" in event_config.get("special_operations", []) and due_obligation is not None:
+            main_classes += tuple(events[due_obligation]["main_classes"])
+            other_classes += tuple(events[due_obligation].get("other_classes", ()))
+        main_classes += tuple(config["event_generic_roles"])
+        # if no role config matches, the last one that was tried is used
+        fallback = other_classes[-1] if other_classes else (main_classes[-1] if main_classes else None)
+        main, main_substring = get_alias_map(main_classes)
+        other, other_substring = get_alias_map(other_classes)
+        event_roles.append({
+            "main": main,
+            "main_substring": main_substring,
+            "other": other,
+            "other_substring": other_substring,
+            "fallback": get_role_entry(fallback) if fallback is not None else None,
+        })
+
+    work_tree_settings = (
+        config["span_layer"], config["relation_layer"], config["priority_layer"], config["priorities"], span_fields,
+        [(fo, fn["field"], fn["required"]) for fo, fn in config["relation_features"].items()],
+    )
+    work_tree_hash = hashlib.sha256((repr(work_tree_settings) + hash_files([os.path.abspath(__file__)])).encode("utf8")).hexdigest()
+
+    return {
+        "span_fields": span_fields,
+        "span_instructions": compile_instructions(config["span_features"]),
+        "relation_instructions": compile_instructions(config["relation_features"]),
+        "role_name_conversions": tuple((re.compile(o), r) for o, r in config["conversions"]["role_names"].items()),
+        "implicit_events": implicit_events,
+        "event_aliases": event_aliases,
+        "event_substring_aliases": event_substring_aliases,
+        "due_obligation": due_obligation,
+        "event_roles": event_roles,
+        "work_tree_hash": work_tree_hash,
+    }
 
-    create_work_tree(in_root, out_root, document_text, start_index_dict, end_index_dict)
 
-    apply_special_operations_before_processing(out_root)
+def compile_config(config):
+    """
+    Return the compiled config for a Processor: a read-only copy of the merged config,
+    so no processing step can change the config shared by all documents (and threads),
+    with the lookup tables of build_lookup_tables under the key "compiled".
+    An already compiled config is returned as it is.
+    """
+    if isinstance(config, FrozenDict):
+        return config
+    config = freeze(config)
+    return FrozenDict({**config, "compiled": freeze(build_lookup_tables(config))})
 
-    process_spans(out_root)
-    process_relations(out_root)
 
-    apply_special_operations_between_processing(out_root)
+def hash_files(paths):
+    file_hash = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as f:
+            file_hash.update(f.read())
+    return file_hash.hexdigest()
 
-    write_events(out_root)
-    write_coref(out_root)
 
-    apply_special_operations_after_processing(out_root)
+def get_config_hash():
+    """
+    Hash the sources of the config modules and of this file (which defines how the config is compiled).
+    """
+    return hash_files(get_config_paths() + [os.path.abspath(__file__)])
 
-    cleanup(out_root)
 
-    # write debug info
-    print(f"See processed file at {os.path.abspath(os.path.join(OUTFOLDER, os.path.basename(outname)))}")
+def dump_pickle(obj, path):
+    """
+    Pickle obj to path. It is written to a temporary file first, so other processes never read a half-written file.
+    """
+    pathlib.Path(os.path.dirname(path) or ".").mkdir(parents=True, exist_ok=True)
+    partial_path = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+    with open(partial_path, "wb") as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(partial_path, path)
 
-    # write xml
-    out_tree = et.ElementTree(out_root)
-    pathlib.Path(OUTFOLDER).mkdir(parents=True, exist_ok=True) 
-    out_tree.write(os.path.join(OUTFOLDER, os.path.basename(outname)), xml_declaration=True, pretty_print=True, encoding="utf8")
-    
-    #print(et.tostring(out_root, encoding='unicode', pretty_print=True))
-    
 
-def process_xmi(infile):
-    in_root = et.parse(infile).getroot()
+def load_compiled_config():
+    """
+    Return the compiled config of the config modules.
+    The compiled config is cached in CONFIG_CACHE_FOLDER, keyed by the hash of the config sources,
+    so it is only rebuilt (and the config modules only imported) after one of them was edited.
+    """
+    cache_path = os.path.join(CONFIG_CACHE_FOLDER, get_config_hash() + ".pickle")
+    try:
+        with open(cache_path, "rb") as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"WARNING: Could not read the cached config {cache_path} ({e!r}), rebuilding it.")
+
+    config = compile_config(load_config(get_config_modules()))
+    try:
+        dump_pickle(config, cache_path)
+        # caches of older config versions are never read again
+        for path in pathlib.Path(CONFIG_CACHE_FOLDER).glob("*.pickle"):
+            if str(path) != cache_path:
+                path.unlink(missing_ok=True)
+    except OSError as e:
+        print(f"WARNING: Could not write the cached config {cache_path} ({e!r}).")
+    return config
+
+
+class FolderSink:
+    """
+    Writes every processed document to its own file in outfolder.
+    Documents are written to a temporary file first, so a failing document doesn't leave a truncated output behind.
+    """
+    def __init__(self, outfolder):
+        self.outfolder = outfolder
+
+    def location(self, membername):
+        return os.path.join(self.outfolder, membername)
+
+    def open(self, membername):
+        pathlib.Path(self.outfolder).mkdir(parents=True, exist_ok=True)
+        return self.location(membername) + ".part"
+
+    def commit(self, membername, target):
+        os.replace(target, self.location(membername))
+
+    def abort(self, target):
+        if os.path.exists(target):
+            os.remove(target)
+
+    def close(self):
+        pass
+
+
+class ArchiveSink:
+    """
+    Writes all processed documents into one zip archive, which is opened on first use and rewritten on every run.
+    Its members are stored uncompressed, so they can be read sequentially or by name without extracting them.
+    Documents are buffered and only added once they are complete, one at a time.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._archive = None
+        self._lock = threading.Lock()
+
+    def location(self, membername):
+        return os.path.join(self.path, membername)
+
+    def open(self, membername):
+        return io.BytesIO()
+
+    def commit(self, membername, target):
+        with self._lock:
+            if self._archive is None:
+                pathlib.Path(os.path.dirname(os.path.abspath(self.path))).mkdir(parents=True, exist_ok=True)
+                self._archive = zipfile.ZipFile(self.path, "w", compression=zipfile.ZIP_STORED)
+                atexit.register(self.close)
+            self._archive.writestr(membername, target.getvalue())
+
+    def abort(self, target):
+        pass
+
+    def close(self):
+        """
+        Write the member index of the archive and close it.
+        """
+        with self._lock:
+            if self._archive is not None:
+                self._archive.close()
+                self._archive = None
+
+
+def write_section(xf, section, pretty_print=True):
+    """
+    Serialise a finished top-level section (text, spans, relations, eventGroups)
+    of the output tree into the open xml file and drop it from the tree,
+    so it doesn't have to be kept in memory until the whole document is done.
+    :param xf: The et.xmlfile writer, positioned inside the doc element.
+    :param section: The section element, a direct child of the output root.
+    """
+    if pretty_print:
+        et.indent(section, space="  ", level=1)
+        xf.write("\n  ")
+    xf.write(section)
+    section.getparent().remove(section)
+
+
+class MemorySink:
+    """
+    Keeps the processed documents in memory (membername -> bytes), e.g. to send them back from the postprocessing service.
+    """
+    def __init__(self):
+        self.documents = {}
+        self._lock = threading.Lock()
+
+    def location(self, membername):
+        return membername
+
+    def open(self, membername):
+        return io.BytesIO()
+
+    def commit(self, membername, target):
+        with self._lock:
+            self.documents[membername] = target.getvalue()
+
+    def abort(self, target):
+        pass
+
+    def close(self):
+        pass
+
+
+class Processor:
+    """
+    Processes XMI files with a fixed, read-only config and writes the results to an output sink.
+    Nothing is changed on the Processor while processing, so process_xmi and process
+    can be called for several documents at once, e.g. from a thread pool.
+
+    :param config: The merged config, defaults to the (cached) compiled config of the config modules. An already compiled config is used as it is.
+    :param outfolder: The folder the processed files are written to.
+    :param archive: Path to a zip file. If set, all processed documents are written into it instead of outfolder.
+    :param pretty_print: False writes compact XML without indentation.
+    :param compression: gzip compression level (1-9) of the output files, 0 writes plain XML.
+    :param token_storage: "standoff" writes the text once plus a table of token offsets instead of one element per token.
+    :param write_span_text: False drops the text attributes of spans, triggers and roles.
+    :param sink: Where the output goes (FolderSink, ArchiveSink, MemorySink), overrides outfolder and archive.
+    :param diagnostics: The Diagnostics collecting the warnings and errors of all documents, a new one by default.
+    :param work_tree_cache: Folder to cache the work tree (the state after create_work_tree) of every document in,
+        keyed by the XMI and the layer_processing config. process_xmi then only parses documents that changed
+        and starts the others at process_spans, e.g. when trying out changes of the event config.
+    """
+    def __init__(self, config=None, outfolder="", archive="", pretty_print=True, compression=0, token_storage="elements", write_span_text=True, sink=None, diagnostics=None, work_tree_cache=""):
+        self.config = load_compiled_config() if config is None else compile_config(config)
+        self.span_layer = self.config["span_layer"]  # the name of the span layer in the XMI file
+        self.relation_layer = self.config["relation_layer"]  # the name of the relation layer in the XMI file
+        if sink is not None:
+            self.sink = sink
+        else:
+            self.sink = ArchiveSink(archive) if archive else FolderSink(outfolder)
+        self.pretty_print = pretty_print
+        self.compression = compression
+        self.token_storage = token_storage
+        self.write_span_text = write_span_text
+        self.diagnostics = Diagnostics() if diagnostics is None else diagnostics
+        self.work_tree_cache = work_tree_cache
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
-    at_least_one_span = in_root.find(f"./custom:{SPAN_LAYER}", namespaces={"custom":"http:///custom.ecore"})
-    if at_least_one_span is None:
-        # stop processing if document doesn't contain annotations
-        return
+    def close(self):
+        """
+        Finish the output, call this once all documents are processed.
+        """
+        self.sink.close()
+
+    def build_work_tree(self, in_root, tokens=None):
+        """
+        Run the steps up to create_work_tree, they only depend on the XMI and the layer_processing config.
+        :param in_root: The root element of the input XML tree.
+        :param tokens: The TokenLayer of the document, read from in_root if not given.
+        :return: (TokenLayer, root of the work tree)
+        """
+        # for debugging
+        #print(et.tostring(in_root, encoding='unicode', pretty_print=True))
+
+        if tokens is None:
+            tokens = TokenLayer.from_xmi(in_root)
+
+        out_root = et.Element("doc")
+        create_work_tree(in_root, out_root, tokens.document_text, tokens.token_begins, tokens.token_ends, self.config)
+        return tokens, out_root
+
+    def process(self, in_root, outname):
+        """
+        Process the XMI file and write the output to a new file.
+        :param in_root: The root element of the input XML tree.
+        :param outname: The name of the output file.
+        """
+        self.write_document(outname, lambda: self.build_work_tree(in_root))
+
+    def write_document(self, outname, build_work_tree):
+        """
+        Process the work tree and write the output to a new file.
+        The output is streamed section by section as soon as a section is final.
+        :param outname: The name of the output file.
+        :param build_work_tree: Function returning the result of Processor.build_work_tree.
+        """
+        config = self.config
+
+        membername = os.path.basename(outname)
+        if self.compression:
+            membername += ".gz"
+        target = self.sink.open(membername)
+
+        try:
+            with contextlib.ExitStack() as stack:
+                out = stack.enter_context(open(target, "wb")) if isinstance(target, str) else target
+                if self.compression:
+                    # compressed here instead of by xmlfile, so the newline after the root element can be written
+                    out = stack.enter_context(gzip.GzipFile(fileobj=out, mode="wb", compresslevel=self.compression, mtime=0))
+                with self.diagnostics.document(os.path.basename(outname)), et.xmlfile(out, encoding="UTF8") as xf:
+                    xf.write_declaration()
+                    with xf.element("doc", nsmap={None: NAMESPACE}):
+                        # the namespace is declared by the writer, the work tree itself stays unqualified
+                        tokens, out_root = build_work_tree()
+
+                        out_text = tokens.text_element(self.token_storage, self.pretty_print)
+                        out_root.insert(0, out_text)
+                        # the text doesn't change anymore, the token strings are kept in tokens.token_texts
+                        write_section(xf, out_text, self.pretty_print)
+
+                        apply_special_operations_before_processing(out_root)
+
+                        spans = SpanRegistry(out_root)
+                        check_relations(out_root, spans)
+                        process_spans(out_root, tokens.token_texts, config, spans)
+                        process_relations(out_root, config)
+
+                        apply_special_operations_between_processing(out_root, spans)
+
+                        write_events(out_root, config, spans)
+                        write_coref(out_root)
+
+                        apply_special_operations_after_processing(out_root, config, spans)
+
+                        cleanup(out_root, config, self.write_span_text, spans)
+
+                        # write debug info
+                        print(f"See processed file at {os.path.abspath(self.sink.location(membername))}")
+
+                        # write xml
+                        for section in list(out_root):
+                            write_section(xf, section, self.pretty_print)
+                        if self.pretty_print:
+                            xf.write("\n")
+                # end the file with a newline like a tree written with et.ElementTree.write
+                out.write(b"\n")
+        except BaseException:
+            self.sink.abort(target)
+            raise
+        self.sink.commit(membername, target)
+
+    def validate(self, in_root, name):
+        """
+        Only run the processing steps that check the annotation (overlaps, required fields, heads,
+        relations, roles and references) and return the diagnostics of the document. Nothing is written.
+        :param in_root: The root element of the input XML tree.
+        :param name: The name of the document in the diagnostics.
+        """
+        config = self.config
+        name = os.path.basename(name)
+
+        with self.diagnostics.document(name):
+            tokens, out_root = self.build_work_tree(in_root)
+            apply_special_operations_before_processing(out_root)
+            spans = SpanRegistry(out_root)
+            check_relations(out_root, spans)
+            process_spans(out_root, tokens.token_texts, config, spans)
+            process_relations(out_root, config)
+            apply_special_operations_between_processing(out_root, spans)
+            write_events(out_root, config, spans)
+            check_references(out_root, spans)
+        return self.diagnostics.for_document(name)
+
+    def has_spans(self, in_root):
+        return in_root.find(f"./custom:{self.span_layer}", namespaces={"custom":"http:///custom.ecore"}) is not None
+
+    def validate_xmi(self, infile, name=None):
+        """
+        Like process_xmi, but only validate the document, see validate.
+        Returns None if the document contains no annotations.
+        """
+        if name is None:
+            name = infile
+        in_root = et.parse(infile).getroot()
+        if not self.has_spans(in_root):
+            return None
+        return self.validate(in_root, name)
+
+    def process_xmi(self, infile, name=None):
+        """
+        :param infile: Path or file object of the XMI file.
+        :param name: Name of the document, required if infile is a file object.
+        """
+        if name is None:
+            name = infile
+        if self.work_tree_cache:
+            self.process_xmi_cached(infile, name)
+            return
+
+        in_root = et.parse(infile).getroot()
+        if not self.has_spans(in_root):
+            # stop processing if document doesn't contain annotations
+            return
+
+        print("="*80)
+        print(f"Processing {os.path.abspath(name)}.")
+
+        outname = os.path.splitext(name)[0] + ".benasch.xml"
+
+        self.process(in_root, outname)
+
+    def process_xmi_group(self, infiles, names=None):
+        """
+        Process the XMI files of all annotators of the same document. The text and the tokens
+        are read from the first file and shared with the others, as long as their text is the same.
+        :param infiles: Paths or file objects of the XMI files.
+        :param names: Names of the documents, required if infiles are file objects.
+        """
+        if names is None:
+            names = infiles
+        tokens = None
+        if self.work_tree_cache:
+            for infile, name in zip(infiles, names):
+                tokens = self.process_xmi_cached(infile, name, tokens)
+            return
+
+        for infile, name in zip(infiles, names):
+            in_root = et.parse(infile).getroot()
+            if not self.has_spans(in_root):
+                continue
+
+            print("="*80)
+            print(f"Processing {os.path.abspath(name)}.")
 
-    print("="*80)
-    print(f"Processing {os.path.abspath(infile)}.")
+            # INCEpTION keeps the same tokens for all annotators, a different text means a different document
+            document_text = in_root.find("./cas:Sofa", namespaces={"cas":"http:///uima/cas.ecore"}).get("sofaString")
+            if tokens is None or tokens.document_text != document_text:
+                tokens = TokenLayer.from_xmi(in_root)
 
-    outname = os.path.splitext(infile)[0] + ".benasch.xml"
+            outname = os.path.splitext(name)[0] + ".benasch.xml"
+            self.write_document(outname, lambda: self.build_work_tree(in_root, tokens))
+
+    def process_xmi_cached(self, infile, name, tokens=None):
+        """
+        process_xmi with the work tree cache. The warnings of the skipped steps are cached as well and reported again.
+        :param tokens: The TokenLayer of another annotator of the same document, used if the text is the same.
+        :return: The TokenLayer of the document, or the given one if the document has no spans.
+        """
+        if hasattr(infile, "read"):
+            xmi = infile.read()
+        else:
+            with open(infile, "rb") as f:
+                xmi = f.read()
+        key = hashlib.sha256(xmi + self.config["compiled"]["work_tree_hash"].encode("utf8")).hexdigest()
+        cache_path = os.path.join(self.work_tree_cache, key + ".pickle")
+        try:
+            with open(cache_path, "rb") as f:
+                cached = pickle.load(f)
+        except FileNotFoundError:
+            cached = None
+        except Exception as e:
+            print(f"WARNING: Could not read the cached work tree {cache_path} ({e!r}), rebuilding it.")
+            cached = None
+
+        if cached is None:
+            in_root = et.parse(io.BytesIO(xmi)).getroot()
+            if not self.has_spans(in_root):
+                self.store_work_tree(cache_path, {"has_spans": False})
+                return tokens
+            document_text = in_root.find("./cas:Sofa", namespaces={"cas":"http:///uima/cas.ecore"}).get("sofaString")
+            if tokens is None or tokens.document_text != document_text:
+                tokens = TokenLayer.from_xmi(in_root)
+        elif not cached["has_spans"]:
+            return tokens
+        elif tokens is None or tokens.document_text != cached["document_text"]:
+            tokens = TokenLayer(cached["document_text"], cached["token_begins"], cached["token_ends"])
+
+        print("="*80)
+        print(f"Processing {os.path.abspath(name)}.")
+
+        outname = os.path.splitext(name)[0] + ".benasch.xml"
+        document_name = os.path.basename(outname)
+
+        def build_work_tree():
+            if cached is not None:
+                for code, message, span_id in cached["diagnostics"]:
+                    report(code, message, span_id)
+                return tokens, et.fromstring(cached["work_tree"])
+
+            # the messages of this step are collected on their own, so all of them are cached, and then reported as usual
+            build_diagnostics = Diagnostics(console_limit=0, record_limit=None)
+            with build_diagnostics.document(document_name):
+                _, out_root = self.build_work_tree(in_root, tokens)
+            messages = [(d.code, d.message, d.span_id) for d in build_diagnostics.records]
+            for code, message, span_id in messages:
+                report(code, message, span_id)
+            self.store_work_tree(cache_path, {
+                "has_spans": True,
+                "document_text": tokens.document_text,
+                "token_begins": tokens.token_begins,
+                "token_ends": tokens.token_ends,
+                "work_tree": et.tostring(out_root),
+                "diagnostics": messages,
+            })
+            return tokens, out_root
+
+        self.write_document(outname, build_work_tree)
+        return tokens
+
+    def store_work_tree(self, cache_path, entry):
+        try:
+            dump_pickle(entry, cache_path)
+        except OSError as e:
+            print(f"WARNING: Could not write the cached work tree {cache_path} ({e!r}).")
 
-    process(in_root, outname)
+
+def get_default_processor():
+    """
+    Return a Processor built from the module settings (OUTFOLDER, ARCHIVE, PRETTY_PRINT, ...).
+    This keeps scripts working that set e.g. postprocess.OUTFOLDER and call process_xmi.
+    A new Processor is built whenever the settings change.
+    """
+    global _default_processor, _default_settings
+    settings = (OUTFOLDER, ARCHIVE, PRETTY_PRINT, COMPRESSION, TOKEN_STORAGE, WRITE_SPAN_TEXT, WORK_TREE_CACHE)
+    with _default_lock:
+        if _default_processor is None or settings != _default_settings:
+            if _default_processor is not None:
+                _default_processor.close()
+            _default_processor = Processor(
+                outfolder=OUTFOLDER,
+                archive=ARCHIVE,
+                pretty_print=PRETTY_PRINT,
+                compression=COMPRESSION,
+                token_storage=TOKEN_STORAGE,
+                write_span_text=WRITE_SPAN_TEXT,
+                work_tree_cache=WORK_TREE_CACHE,
+            )
+            _default_settings = settings
+        return _default_processor
+
+
+def close_archive():
+    """
+    Write the member index of the archive written by the module level functions and close it.
+    Call this once all documents are processed.
+    """
+    with _default_lock:
+        if _default_processor is not None:
+            _default_processor.close()
+
+
+def process(in_root, outname):
+    get_default_processor().process(in_root, outname)
+
+
+def process_xmi(infile):
+    get_default_processor().process_xmi(infile)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,238 @@
+"""
+A small local HTTP service around postprocess.py for annotation QA.
+The compiled config and the worker threads stay warm between requests, so only
+the documents themselves need to be processed. Edits of the files in
+postprocess_config are picked up automatically with the next request.
+
+Endpoints:
+POST /process?format=xml|column|warnings
+    The body is either a single XMI file or an INCEpTION export (.zip).
+    xml: the BeNASch XML (a zip archive if the export contains more than one document)
+    column: the column format as written by create_column_corpus
+    warnings: a JSON object with the warnings and errors (code, severity, span id, message) of each document
+GET /status
+    Queue depth, processed requests and latency statistics as JSON.
+
+Run it with "python postprocess_service.py" and send documents, e.g. with
+curl --data-binary @export.zip "http://127.0.0.1:8765/process?format=warnings"
+"""
+
+import asyncio
+import io
+import json
+import os
+import sys
+import threading
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+
+import postprocess
+from diagnostics import Diagnostics
+from transformation.to_column import process_document
+from unzip_export import read_export
+
+
+HOST = "127.0.0.1"
+PORT = 8765
+WORKERS = 4  # number of documents processed at the same time
+LATENCY_WINDOW = 1000  # number of recent requests the latency statistics are computed over
+
+
+class ThreadOutput(io.TextIOBase):
+    """
+    Replaces sys.stdout, so everything a worker thread prints while processing
+    a request is collected for that request instead of cluttering the console.
+    Other output goes to the console.
+    """
+    def __init__(self, fallback):
+        self.fallback = fallback
+        self.local = threading.local()
+
+    def capture(self, buffer):
+        self.local.buffer = buffer
+
+    def write(self, s):
+        buffer = getattr(self.local, "buffer", None)
+        if buffer is None:
+            return self.fallback.write(s)
+        buffer.write(s)
+        return len(s)
+
+    def flush(self):
+        self.fallback.flush()
+
+
+class ConfigWatcher:
+    """
+    Keeps the compiled config and reloads it when one of the config modules changes on disk.
+    Documents already being processed keep using the config they started with.
+    """
+    def __init__(self):
+        self.mtimes = self.get_mtimes()
+        self.config = postprocess.load_compiled_config()
+
+    def get_mtimes(self):
+        return [os.stat(path).st_mtime_ns for path in postprocess.get_config_paths()]
+
+    def get_config(self):
+        mtimes = self.get_mtimes()
+        if mtimes != self.mtimes:
+            self.config = postprocess.load_compiled_config()
+            self.mtimes = mtimes
+            print("Config files changed, reloaded the config.")
+        return self.config
+
+
+class Service:
+    def __init__(self, workers=WORKERS):
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(workers)
+        self.watcher = ConfigWatcher()
+        self.output = ThreadOutput(sys.stdout)
+        self.in_flight = 0  # requests submitted to the pool and not finished yet
+        self.running = 0  # requests a worker is currently processing
+        self.running_lock = threading.Lock()
+        self.processed = 0
+        self.failed = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def read_documents(self, body):
+        """
+        Return a list of (name, xmi) from the request body.
+        """
+        if body[:4] == b"PK\x03\x04":
+            with zipfile.ZipFile(io.BytesIO(body), "r") as archive:
+                documents = list(read_export(archive))
+                if not documents:
+                    # a single annotator archive (e.g. admin.zip with admin.xmi)
+                    documents = [(n, archive.read(n)) for n in archive.namelist() if n.endswith(".xmi")]
+            return documents
+        return [("document.xmi", body)]
+
+    def run_job(self, config, documents, out_format):
+        """
+        Process the documents of one request in a worker thread.
+        """
+        with self.running_lock:
+            self.running += 1
+        sink = postprocess.MemorySink()
+        # the collector only lives for this request, so all messages are kept
+        diagnostics = Diagnostics(console_limit=0, record_limit=None)
+        processor = postprocess.Processor(config=config, sink=sink, diagnostics=diagnostics)
+        self.output.capture(io.StringIO())
+        try:
+            for name, xmi in documents:
+                processor.process_xmi(io.BytesIO(xmi), name=name)
+        finally:
+            self.output.capture(None)
+            with self.running_lock:
+                self.running -= 1
+
+        if out_format == "warnings":
+            warnings = {membername: [] for membername in sorted(sink.documents)}
+            for d in diagnostics.records:
+                warnings.setdefault(d.document, []).append({"code": d.code, "severity": d.severity, "span_id": d.span_id, "message": d.message})
+            return "application/json", json.dumps(warnings, ensure_ascii=False, indent=2).encode("utf8")
+        if out_format == "column":
+            out = []
+            for membername, document in sorted(sink.documents.items()):
+                outstring, _ = process_document(io.BytesIO(document))
+                if outstring:
+                    out.append(f"# {membername}\n{outstring}\n")
+            return "text/plain; charset=utf-8", "".join(out).encode("utf8")
+        if len(sink.documents) == 1:
+            return "application/xml", next(iter(sink.documents.values()))
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, "w", compression=zipfile.ZIP_STORED) as zf:
+            for membername, document in sorted(sink.documents.items()):
+                zf.writestr(membername, document)
+        return "application/zip", archive.getvalue()
+
+    def status(self):
+        latencies = sorted(self.latencies)
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))] if latencies else None
+        return {
+            "queue_depth": self.in_flight - self.running,
+            "running": self.running,
+            "workers": self.workers,
+            "processed": self.processed,
+            "failed": self.failed,
+            "latency_seconds": {
+                "mean": sum(latencies) / len(latencies) if latencies else None,
+                "p50": percentile(0.5),
+                "p95": percentile(0.95),
+                "max": latencies[-1] if latencies else None,
+            },
+        }
+
+    async def handle_process(self, query, body):
+        out_format = query.get("format", ["xml"])[0]
+        if out_format not in ["xml", "column", "warnings"]:
+            return 400, "text/plain", f"Unknown format {out_format}.".encode("utf8")
+        try:
+            documents = self.read_documents(body)
+        except (zipfile.BadZipFile, KeyError) as e:
+            return 400, "text/plain", f"Could not read the export: {e}".encode("utf8")
+        config = self.watcher.get_config()
+        start = time.perf_counter()
+        self.in_flight += 1
+        try:
+            loop = asyncio.get_running_loop()
+            content_type, payload = await loop.run_in_executor(self.pool, self.run_job, config, documents, out_format)
+        except Exception as e:
+            self.failed += 1
+            return 500, "text/plain", f"Processing failed: {e!r}".encode("utf8")
+        finally:
+            self.in_flight -= 1
+        self.latencies.append(time.perf_counter() - start)
+        self.processed += 1
+        return 200, content_type, payload
+
+    async def handle_connection(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                key, _, value = line.decode("latin-1").partition(":")
+                headers[key.strip().lower()] = value.strip()
+            if len(request_line) < 2:
+                return
+            method, url = request_line[0], urlsplit(request_line[1])
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+            if method == "GET" and url.path == "/status":
+                status, content_type, payload = 200, "application/json", json.dumps(self.status()).encode("utf8")
+            elif method == "POST" and url.path == "/process":
+                status, content_type, payload = await self.handle_process(parse_qs(url.query), body)
+            else:
+                status, content_type, payload = 404, "text/plain", b"Not found."
+
+            reason = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error"}[status]
+            writer.write(
+                f"HTTP/1.1 {status} {reason}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode("latin-1")
+            )
+            writer.write(payload)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host=HOST, port=PORT):
+        sys.stdout = self.output
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f"Serving postprocessing on http://{host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == "__main__":
+    asyncio.run(Service().serve())
@@ -7,6 +7,8 @@ We will skip any files which do not contain at least one <Span>-Node!
 import glob
 import postprocess
 import os
+from concurrent.futures import ThreadPoolExecutor
+from unzip_export import split_filename
 
 # SET PATH TO RELEVANT CORPUS FOLDER
 DATA = "./data/example_hgb/"
@@ -14,9 +16,44 @@ DATA = "./data/example_hgb/"
 # FOLDER PATHS (best to keep like this)
 UNZIPPED = os.path.join(DATA, "unzipped")
 OUTPUT = os.path.join(DATA, "processed")
-postprocess.OUTFOLDER = OUTPUT
+# set a path to write all processed documents into a single archive instead (e.g. os.path.join(DATA, "processed.zip"))
+ARCHIVE = ""
+
+# set a folder to cache the work tree of every document (e.g. os.path.join(DATA, "work_trees")),
+# reruns then only parse the documents that changed, useful when trying out changes of the event config
+WORK_TREE_CACHE = ""
+
+# the number of warnings and errors by code and document is written here
+DIAGNOSTICS = os.path.join(DATA, "diagnostics.jsonl")
+
+# the annotators of the unzipped files, only needed if annotator names contain "_",
+# otherwise the document name is taken to start after the first "_"
+ANNOTATORS = []
+
+# number of documents processed at the same time, all annotators of a document are processed by the same worker
+# (the console output of the documents will be interleaved)
+WORKERS = 1
+
+
+def group_by_document(infiles, annotators=None):
+    """
+    Group the unzipped files ({annotator}_{document}) by document, so the text and tokens
+    of a document are only read once for all its annotators.
+    """
+    groups = {}
+    for infile in infiles:
+        _, document = split_filename(infile, annotators)
+        groups.setdefault(document, []).append(infile)
+    return list(groups.values())
 
 
 if __name__ == "__main__":
-    for infile in sorted(glob.glob(os.path.join(UNZIPPED, "*"))):
-        postprocess.process_xmi(infile)
\ No newline at end of file
+    infiles = sorted(glob.glob(os.path.join(UNZIPPED, "*")))
+    with postprocess.Processor(outfolder=OUTPUT, archive=ARCHIVE, work_tree_cache=WORK_TREE_CACHE) as processor, ThreadPoolExecutor(WORKERS) as pool:
+        list(pool.map(processor.process_xmi_group, group_by_document(infiles, ANNOTATORS)))
+    processor.diagnostics.write_summary(DIAGNOSTICS)
+    print("="*80)
+    for line in processor.diagnostics.summary():
+        if line["document"] is None:
+            print(f"{line['severity'].upper()} {line['code']}: {line['count']}")
+    print(f"See the diagnostics summary at {os.path.abspath(DIAGNOSTICS)}")
@@ -3,12 +3,123 @@ Conversion script to transform standard XML (may 2025) to a column format with t
 column 1 is always the text, the other columns can be defined.
 """
 
+import gzip
+from bisect import bisect_left, bisect_right
+from collections import Counter
 from lxml import etree as et
 
 
 DEFAULT_NAMESPACE = "https://dhbern.github.io/BeNASch/ns"
 
 
+def parse_document(docpath):
+    """
+    Parse a BeNASch file, gzip-compressed files (.gz) are decompressed transparently.
+    docpath can also be an open file object, e.g. a member of a corpus archive.
+    """
+    if str(getattr(docpath, "name", docpath)).endswith(".gz"):
+        with gzip.open(docpath, "rb") as f:
+            return et.parse(f)
+    return et.parse(docpath)
+
+
+def scan_labels(docpath):
+    """
+    Count the labels (element.class) of the spans of a BeNASch file without building the tree,
+    e.g. to balance the labels when splitting a corpus.
+    """
+    def count(source):
+        counts = Counter()
+        for _, span in et.iterparse(source, tag=f"{{{DEFAULT_NAMESPACE}}}span"):
+            if span.get("class"):
+                counts[f"{span.get('element')}.{span.get('class')}"] += 1
+            span.clear()
+        return counts
+
+    if str(getattr(docpath, "name", docpath)).endswith(".gz"):
+        with gzip.open(docpath, "rb") as f:
+            return count(f)
+    return count(docpath)
+
+
+def read_tokens(root):
+    """
+    Return the token strings of a BeNASch document.
+    Both storage modes of the text node are supported: one token element per token,
+    or standoff storage with the raw text and a table of token offsets.
+    """
+    text = root.find("./b:text", namespaces={"b": DEFAULT_NAMESPACE})
+    if text.get("storage") == "standoff":
+        raw = text.findtext("./b:raw", default="", namespaces={"b": DEFAULT_NAMESPACE})
+        offsets = [int(x) for x in text.findtext("./b:offsets", default="", namespaces={"b": DEFAULT_NAMESPACE}).split()]
+        return [raw[b:e] for b, e in zip(offsets[::2], offsets[1::2])]
+    # TODO: Enable processing of line elements and implement them as linebreaks
+    return [t.text for t in text.iterfind(".//b:token", namespaces={"b": DEFAULT_NAMESPACE})]
+
+
+def read_line_starts(root):
+    """
+    Return the sorted indices of the tokens that start a new line (except the first token).
+    Lines are taken from line elements around the tokens or, with standoff storage, from the line breaks of the raw text.
+    postprocess doesn't write line elements, so the lines are only known with TOKEN_STORAGE = "standoff".
+    :return: The line starts, None if the document has neither.
+    """
+    text = root.find("./b:text", namespaces={"b": DEFAULT_NAMESPACE})
+    if text.get("storage") == "standoff":
+        raw = text.findtext("./b:raw", default="", namespaces={"b": DEFAULT_NAMESPACE})
+        offsets = [int(x) for x in text.findtext("./b:offsets", default="", namespaces={"b": DEFAULT_NAMESPACE}).split()]
+        begins, ends = offsets[::2], offsets[1::2]
+        return [i for i in range(1, len(begins)) if "\n" in raw[ends[i-1]:begins[i]]]
+    lines = text.findall(".//b:line", namespaces={"b": DEFAULT_NAMESPACE})
+    if not lines:
+        return None
+    line_starts = []
+    for line in lines:
+        first = line.find(".//b:token", namespaces={"b": DEFAULT_NAMESPACE})
+        if first is not None and int(first.get("token_id")) > 0:
+            line_starts.append(int(first.get("token_id")))
+    return sorted(line_starts)
+
+
+def get_windows(start, end, size, overlap=0, line_starts=None):
+    """
+    Split the tokens start to end (exclusive) into windows of at most size tokens,
+    consecutive windows share up to overlap tokens.
+    With line_starts, a window ends at the last line break that fits and the next one starts at a line break
+    within the overlap. A window is only ended at a line break if it keeps more than size - overlap tokens,
+    otherwise (e.g. for lines longer than size) it is cut at size tokens.
+    :return: [(window start, window end)]
+    """
+    if end - start <= size:
+        return [(start, end)]
+    line_starts = line_starts or []
+    windows = []
+    window_start = start
+    previous_end = start
+    while True:
+        window_end = min(window_start + size, end)
+        if window_end < end:
+            i = bisect_right(line_starts, window_end) - 1
+            # every window has to cover tokens the previous one didn't
+            if i >= 0 and line_starts[i] > previous_end and line_starts[i] - window_start > size - overlap:
+                window_end = line_starts[i]
+        windows.append((window_start, window_end))
+        previous_end = window_end
+        if window_end >= end:
+            return windows
+        next_start = window_end - overlap
+        i = bisect_left(line_starts, next_start)
+        if i < len(line_starts) and line_starts[i] <= window_end:
+            next_start = line_starts[i]
+        window_start = max(next_start, window_start + 1)
+
+
+def check_window_options(window_size, window_overlap):
+    if window_size and not 0 <= window_overlap < window_size:
+        raise ValueError(f"The window overlap has to be at least 0 and smaller than the window size, "
+                         f"got overlap {window_overlap} for size {window_size}.")
+
+
 def delve_into_children(node, valid_set, collector):
     for child in node:
         for valid_node, instr in valid_set:
@@ -20,7 +131,9 @@ def delve_into_children(node, valid_set, collector):
             delve_into_children(child, valid_set, collector)
 
 
-def apply_tag_conversion(node, conversion_instructions):
+def apply_tag_conversion(node, conversion_instructions, rename_labels=None):
+    if rename_labels is None:
+        rename_labels = PROCESSING_CONFIG.get("rename_labels", {})
     out = []
     for elem in conversion_instructions:
         if elem.startswith("^"):
@@ -28,7 +141,7 @@ def apply_tag_conversion(node, conversion_instructions):
             elem = elem[1:]
         if elem.startswith("@"):
             attr = node.get(elem[1:])
-            attr = PROCESSING_CONFIG.get("rename_labels", {}).get(attr, attr)
+            attr = rename_labels.get(attr, attr)
             if attr is None:
                 out.append("")
             else:
@@ -38,7 +151,7 @@ def apply_tag_conversion(node, conversion_instructions):
     return "".join(out)
 
 
-def create_idx_dict(node_list):
+def create_idx_dict(node_list, rename_labels=None):
     idx_dict = {}
     tagset = set()
     for node, instr in node_list:
@@ -46,7 +159,7 @@ def create_idx_dict(node_list):
         end = int(node.get("end")) + 1
         for i in range(start, end):
             prefix = "B-" if i == start else "I-"
-            tag = prefix + apply_tag_conversion(node, instr)
+            tag = prefix + apply_tag_conversion(node, instr, rename_labels)
             tagset.add(tag)
             idx_dict[i] = tag
     return idx_dict, tagset
@@ -76,52 +189,109 @@ def add_base_labels(rows: list, elem, label_setting):
     rows.append(["[E-" + label.upper() + "]"] + ["O"]*col_count)
 
 
-def process_document(docpath, config=None):
-    if config is None:
-        config = PROCESSING_CONFIG
+class XPathCache:
+    """
+    Evaluates every xpath only once per context node, so configs converting the same document
+    share the nodes of the xpaths they have in common (e.g. the base xpaths of config variants).
+    """
+    def __init__(self):
+        self.results = {}
 
-    root = et.parse(docpath).getroot()
-    spans = root.find("./b:spans", namespaces={"b": DEFAULT_NAMESPACE})
-    tokens = root.findall("./b:text//b:token", namespaces={"b": DEFAULT_NAMESPACE})  # TODO: Enable processing of line elements and implement them as linebreaks
+    def xpath(self, node, path):
+        # the key keeps a reference to the node, so lxml returns the same element object for it
+        key = (node, path)
+        if key not in self.results:
+            self.results[key] = node.xpath(path, namespaces={"b": DEFAULT_NAMESPACE})
+        return self.results[key]
+
+
+def convert_document(spans, tokens, config, xpaths=None, window_size=0, window_overlap=0, line_starts=None):
+    """
+    Write the samples of one document as defined in config.
+    :param spans: The spans element of the document.
+    :param tokens: The token strings of the document.
+    :param xpaths: An XPathCache shared by all configs the document is converted with.
+    :param window_size: Samples longer than this are split into windows (see get_windows), 0 keeps them whole.
+    """
+    if xpaths is None:
+        xpaths = XPathCache()
+    rename_labels = config.get("rename_labels", {})
 
     out_text = []
 
     tagset = set()
 
     for base in config["base"]:
-        nodes = spans.xpath(base["xpath"], namespaces={"b": DEFAULT_NAMESPACE})
+        nodes = xpaths.xpath(spans, base["xpath"])
         for node in nodes:
             if base["xpath"] == ".":
                 start = 0
                 end = len(tokens)
-                incl_tokens = [t.text for t in tokens]
+                incl_tokens = tokens
             else:
                 start = int(node.get("start"))
                 end = int(node.get("end"))+1
-                incl_tokens = [t.text for t in tokens[start:end]]
+                incl_tokens = tokens[start:end]
             new_columns = []
             for column in config["columns"]:
                 valid_nodes = []
                 for c in column:
-                    valid_nodes.extend([(x, c["tag"]) for x in node.xpath(c["xpath"], namespaces={"b": DEFAULT_NAMESPACE})])
+                    valid_nodes.extend([(x, c["tag"]) for x in xpaths.xpath(node, c["xpath"])])
                 chosen_nodes = []
                 delve_into_children(node, valid_nodes, chosen_nodes)
-                chosen_nodes_dict, tags = create_idx_dict(chosen_nodes)
+                chosen_nodes_dict, tags = create_idx_dict(chosen_nodes, rename_labels)
                 tagset.update(tags)
                 new_column = [chosen_nodes_dict[i] if i in chosen_nodes_dict else "O" for i in range(start, end)]
                 new_columns.append(new_column)
             columns = [incl_tokens] + new_columns
-            rows = list(zip(*columns))
-
-            if "label" in base:
-                add_base_labels(rows, node, base["label"])
-            
-            for row in rows:
-                out_text.append("\t".join(row))
-            out_text.append("")
+
+            if window_size:
+                windows = get_windows(start, end, window_size, window_overlap, line_starts)
+            else:
+                windows = [(start, end)]
+            for window_start, window_end in windows:
+                rows = list(zip(*[column[window_start-start:window_end-start] for column in columns]))
+                if window_start > start:
+                    # a span cut off by the start of the window begins in the window
+                    rows[0] = rows[0][:1] + tuple("B-" + tag[2:] if tag.startswith("I-") else tag for tag in rows[0][1:])
+
+                if "label" in base:
+                    add_base_labels(rows, node, base["label"])
+
+                for row in rows:
+                    out_text.append("\t".join(row))
+                out_text.append("")
     return "\n".join(out_text), tagset
 
 
+def process_document(docpath, config=None, configs=None, window_size=0, window_overlap=0, window_at_lines=False):
+    """
+    Convert a BeNASch file to the column format.
+    :param config: The processing config, PROCESSING_CONFIG if not given.
+    :param configs: Named configs ({name: config}), the document is parsed once and converted with each of them.
+    :param window_size: Split samples longer than this many tokens into windows sharing window_overlap tokens, 0 keeps them whole.
+    :param window_at_lines: End the windows at line breaks where possible.
+    :return: (columns, tagset), or {name: (columns, tagset)} if configs are given.
+    """
+    check_window_options(window_size, window_overlap)
+    root = parse_document(docpath).getroot()
+    spans = root.find("./b:spans", namespaces={"b": DEFAULT_NAMESPACE})
+    tokens = read_tokens(root)
+    line_starts = None
+    if window_size and window_at_lines:
+        line_starts = read_line_starts(root)
+        if line_starts is None:
+            print(f"WARNING! {docpath} contains no line breaks (they are only kept with standoff token storage), its windows are cut at the window size.")
+
+    xpaths = XPathCache()
+    windows = {"window_size": window_size, "window_overlap": window_overlap, "line_starts": line_starts}
+    if configs is not None:
+        return {name: convert_document(spans, tokens, c if c is not None else PROCESSING_CONFIG, xpaths, **windows) for name, c in configs.items()}
+    if config is None:
+        config = PROCESSING_CONFIG
+    return convert_document(spans, tokens, config, xpaths, **windows)
+
+
 # PREFIX ALL ELEMENTS WITH B: FOR THE NAMESPACE
 PROCESSING_CONFIG = {
     # in the first part, we define which elements the texts are based on
@@ -0,0 +1,108 @@
+"""
+Conversion script to transform standard XML (may 2025) to nested spans, an alternative to the column format.
+Every document is written once, as its tokens, the spans of each column and the events, instead of one
+BIO sample per base span that repeats every token for each span it is nested in.
+
+The same config as for to_column is used. A span is written if a sample of to_column would label it:
+it fits a column xpath and there is a base node above it with no other span fitting the column in between.
+The column xpaths are evaluated over the whole document instead of per base node, the base labels are not written.
+"""
+
+from transformation.to_column import (
+    DEFAULT_NAMESPACE, PROCESSING_CONFIG, XPathCache, apply_tag_conversion, parse_document, read_tokens
+)
+
+
+NS = {"b": DEFAULT_NAMESPACE}
+
+
+def get_column_spans(spans, base_nodes, column, rename_labels, xpaths):
+    """
+    Return the spans of one column as [start, end, label] (end exclusive) sorted by start, outer spans first.
+    """
+    # if a node fits multiple xpaths, only the first one is used
+    instructions = {}
+    for c in column:
+        for node in xpaths.xpath(spans, c["xpath"]):
+            instructions.setdefault(node, c["tag"])
+
+    out = []
+    tagset = set()
+    for node, instr in instructions.items():
+        parent = node.getparent()
+        while parent is not None and parent not in base_nodes and parent not in instructions:
+            parent = parent.getparent()
+        if parent is None or parent not in base_nodes:
+            continue
+        label = apply_tag_conversion(node, instr, rename_labels)
+        tagset.add(label)
+        out.append([int(node.get("start")), int(node.get("end")) + 1, label])
+    out.sort(key=lambda x: (x[0], -x[1], x[2]))
+    return out, tagset
+
+
+def read_events(root, spans):
+    """
+    Return the events as {"id", "class", "trigger": [start, end] or None, "roles": [[role, start, end]]}, ends exclusive.
+    """
+    extents = {span.get("id"): (int(span.get("start")), int(span.get("end")) + 1) for span in spans.iter(f"{{{DEFAULT_NAMESPACE}}}span")}
+    events = []
+    for event_group in root.iterfind("./b:eventGroups/b:eventGroup", NS):
+        trigger = event_group.find("./b:trigger", NS)
+        if trigger is not None and trigger.get("start") is not None:
+            trigger = [int(trigger.get("start")), int(trigger.get("end")) + 1]
+        else:
+            trigger = None
+        for event in event_group.iterfind("./b:event", NS):
+            roles = []
+            for role in event.iterfind("./b:role", NS):
+                extent = extents.get(role.get("ref"))
+                if extent is not None:
+                    roles.append([role.get("role"), extent[0], extent[1]])
+            events.append({"id": event.get("event_id"), "class": event_group.get("class"), "trigger": trigger, "roles": roles})
+    return events
+
+
+def convert_document(spans, tokens, events, config, xpaths=None):
+    """
+    :return: ({"tokens", "spans": one list of spans per column, "events"}, tagset)
+    """
+    if xpaths is None:
+        xpaths = XPathCache()
+    base_nodes = set()
+    for base in config["base"]:
+        base_nodes.update(xpaths.xpath(spans, base["xpath"]))
+
+    columns = []
+    tagset = set()
+    for column in config["columns"]:
+        column_spans, tags = get_column_spans(spans, base_nodes, column, config.get("rename_labels", {}), xpaths)
+        columns.append(column_spans)
+        tagset.update(tags)
+    return {"tokens": tokens, "spans": columns, "events": events}, tagset
+
+
+def process_document(docpath, config=None, configs=None):
+    """
+    Convert a BeNASch file to nested spans.
+    :param config: The processing config, PROCESSING_CONFIG of to_column if not given.
+    :param configs: Named configs ({name: config}), the document is parsed once and converted with each of them.
+    :return: (document, tagset), or {name: (document, tagset)} if configs are given.
+    """
+    root = parse_document(docpath).getroot()
+    spans = root.find("./b:spans", NS)
+    tokens = read_tokens(root)
+    events = read_events(root, spans)
+
+    xpaths = XPathCache()
+    if configs is not None:
+        return {name: convert_document(spans, tokens, events, c if c is not None else PROCESSING_CONFIG, xpaths) for name, c in configs.items()}
+    if config is None:
+        config = PROCESSING_CONFIG
+    return convert_document(spans, tokens, events, config, xpaths)
+
+
+if __name__ == "__main__":
+    document, tagset = process_document("./data/example_hgb/processed/test_evt_ids.benasch.xml")
+    print(document)
+    print(tagset)
@@ -3,6 +3,7 @@ Executing this script will unzip the exported documents.
 """
 
 import glob
+import io
 import os
 import zipfile
 
@@ -18,6 +19,46 @@ UNZIPPED = os.path.join(DATA, "unzipped")
 ANNOTATORS = []
 
 
+def read_export(archive, annotators=None):
+    """
+    Yield (filename, xmi) for every annotated document in an INCEpTION export,
+    given as an open zipfile.ZipFile, without extracting it to disk.
+    filename is the name the document would get in the unzipped folder.
+    """
+    for name in sorted(archive.namelist()):
+        parts = name.split("/")
+        if len(parts) < 3 or parts[-3] != "annotation" or not parts[-1].endswith(".zip"):
+            continue
+        username = parts[-1].replace(".zip", "")
+        if username == "INITIAL_CAS":
+            continue
+        if annotators and username not in annotators:
+            continue
+        with zipfile.ZipFile(io.BytesIO(archive.read(name)), 'r') as user_archive:
+            xmi = user_archive.read(username + ".xmi")
+        yield (username + "_" + parts[-2]).replace(".txt", ".xmi"), xmi
+
+
+def split_filename(filename, annotators=None):
+    """
+    Split the name of an unzipped or processed file ({annotator}_{document}) into (annotator, document).
+    Both annotator and document names can contain "_". If annotators are given, the longest annotator name the
+    file name starts with is split off, (None, filename) is returned if there is none.
+    Without annotators, the name is split at the first "_".
+    """
+    filename = os.path.basename(filename)
+    if annotators:
+        # longest name first, in case one annotator name is the prefix of another one
+        for annotator in sorted(annotators, key=len, reverse=True):
+            if filename.startswith(annotator + "_"):
+                return annotator, filename[len(annotator) + 1:]
+        return None, filename
+    if "_" not in filename:
+        return None, filename
+    annotator, _, document = filename.partition("_")
+    return annotator, document
+
+
 if __name__ == "__main__":
     for infolder in glob.glob(os.path.join(EXPORT, "*")):
         if not os.path.isdir(infolder):  # don't process the zip files
@@ -0,0 +1,96 @@
+"""
+Quick annotation QA: checks all documents of an export for overlaps, missing required fields,
+missing heads, dangling relations and roles that don't match an event, and prints a report per
+document. Only the checking steps of postprocess.py are run and nothing is written, so this
+is fast enough to run over the whole project after every curation session.
+"""
+
+import glob
+import io
+import os
+import sys
+import zipfile
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import postprocess
+from diagnostics import Diagnostic, Diagnostics
+from unzip_export import read_export
+
+
+# SET PATH TO RELEVANT CORPUS FOLDER
+DATA = "./data/example_hgb/"
+
+# an INCEpTION export (.zip) or a folder with unzipped XMI files
+EXPORT = os.path.join(DATA, "exports", "example_hgb.zip")
+
+# Which annotators to check, leave empty for all (only used for exports)
+ANNOTATORS = []
+
+# number of documents checked at the same time, None uses all CPUs
+WORKERS = None
+
+_processor = None  # the Processor of a worker process
+
+
+def init_worker():
+    global _processor
+    # the messages are printed in the report, not by the workers
+    _processor = postprocess.Processor(sink=postprocess.MemorySink(), diagnostics=Diagnostics(console_limit=0, record_limit=None))
+
+
+def validate_document(document):
+    """
+    :param document: (name, xmi) with xmi as bytes, or the path of an XMI file.
+    :return: (name, list of Diagnostic), the list is None if the document contains no annotations.
+    """
+    if isinstance(document, tuple):
+        name, xmi = document
+        infile = io.BytesIO(xmi)
+    else:
+        name, infile = os.path.basename(document), document
+    try:
+        diagnostics = _processor.validate_xmi(infile, name=name)
+    except Exception as e:
+        # report the document instead of aborting the whole run
+        diagnostics = _processor.diagnostics.for_document(name)
+        diagnostics.append(Diagnostic("processing-failed", "error", name, None, f"ERROR: Checking the document failed ({e!r})."))
+    finally:
+        # the worker checks many documents, the messages of this one are returned and not needed anymore
+        _processor.diagnostics.pop_document(name)
+    return name, diagnostics
+
+
+def iter_documents(export, annotators=None):
+    if os.path.isdir(export):
+        yield from sorted(glob.glob(os.path.join(export, "*")))
+        return
+    with zipfile.ZipFile(export, "r") as archive:
+        yield from read_export(archive, annotators)
+
+
+def print_report(results):
+    """
+    Print the diagnostics of each document and return the number of messages per severity.
+    """
+    totals = Counter()
+    for name, diagnostics in results:
+        if diagnostics is None:
+            continue
+        severities = Counter(d.severity for d in diagnostics)
+        totals.update(severities)
+        print("="*80)
+        print(f"{name}: {severities['error']} errors, {severities['warning']} warnings")
+        for d in diagnostics:
+            print(f"  [{d.code}] {d.message}")
+    return totals
+
+
+if __name__ == "__main__":
+    with ProcessPoolExecutor(WORKERS, initializer=init_worker) as pool:
+        results = pool.map(validate_document, iter_documents(EXPORT, ANNOTATORS), chunksize=4)
+        totals = print_report(results)
+    print("="*80)
+    print(f"{totals['error']} errors, {totals['warning']} warnings")
+    if totals["error"]:
+        sys.exit(1)